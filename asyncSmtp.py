@@ -0,0 +1,293 @@
+import asyncio
+import base64
+import logging
+from collections import deque
+
+from recipients import MAX_RECIPIENTS, RecipientSet
+from smtp import CAPABILITIES, INSECURE_TLS_SESSIONS, LOCAL_HOSTNAME, \
+    SMTP_SERVER, TLS_SESSIONS, TOO_MANY_RECIPIENTS, SMTPCapabilities, \
+    SMTPDeliveryUnknownException, SMTPDisconnectedException, SMTPException, \
+    SMTPPermanentException, SMTPRecipientsRefusedException, \
+    check_mail_size, decode_response, dot_stuff, get_batch_result, \
+    get_mail_from, get_refused, get_rejected, get_response_exception, \
+    is_certificate_error, parse_response
+
+
+class ResumingSSLContext:
+    def __init__(self, context, session):
+        self._context = context
+        self._session = session
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None):
+        return self._context.wrap_bio(incoming, outgoing,
+                                      server_side=server_side,
+                                      server_hostname=server_hostname,
+                                      session=self._session)
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+
+class AsyncSMTPClient:
+    def __init__(self, login, passwd, server=None, disable_ssl=False,
+                 timeout=7, local_hostname=LOCAL_HOSTNAME,
+                 max_recipients=MAX_RECIPIENTS, verify_tls=True,
+                 tls_sessions=None):
+        self._server = SMTP_SERVER if server is None else server
+        self._disable_ssl = disable_ssl
+        self._tls_sessions = tls_sessions
+        if tls_sessions is None:
+            self._tls_sessions = TLS_SESSIONS if verify_tls \
+                else INSECURE_TLS_SESSIONS
+        self._timeout = timeout
+        self._login = login
+        self._passwd = passwd
+        self._reader = None
+        self._writer = None
+        self._transactions = 0
+        self._max_recipients = max_recipients
+        self._local_hostname = local_hostname
+        self._capabilities = SMTPCapabilities()
+
+    @property
+    def server(self):
+        return self._server
+
+    @property
+    def capabilities(self):
+        return self._capabilities
+
+    @property
+    def tls_session_reused(self):
+        ssl_object = self._writer.get_extra_info('ssl_object')
+        return bool(getattr(ssl_object, 'session_reused', False))
+
+    @property
+    def extensions(self):
+        return self._capabilities.extensions
+
+    @property
+    def max_size(self):
+        return self._capabilities.max_size
+
+    @property
+    def max_recipients(self):
+        limits = [e for e in (self._max_recipients,
+                              self._capabilities.max_recipients)
+                  if e is not None]
+        return min(limits, default=None)
+
+    async def connect(self):
+        await self._create_connection(self._server, self._disable_ssl)
+        await self._ehlo()
+        await self._auth_login(self._login, self._passwd)
+        ssl_object = self._writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            self._tls_sessions.set(self._server, ssl_object.session)
+        return self
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        raise SMTPDisconnectedException('Server is not available')
+
+    async def _create_connection(self, server, disable_ssl):
+        ssl_context = None
+        if not disable_ssl:
+            ssl_context = self._tls_sessions.context
+            session = self._tls_sessions.get(server)
+            if session is not None:
+                ssl_context = ResumingSSLContext(ssl_context, session)
+
+        host, port = server
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=ssl_context),
+                self._timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            if is_certificate_error(e):
+                raise SMTPPermanentException(
+                    f'TLS certificate verification failed: {e}')
+            self._disconnect()
+
+        await self._recv()
+
+    def _handle_response_code(self, code, resp):
+        exc = get_response_exception(code, resp)
+        if exc is not None:
+            self._writer.close()
+            raise exc
+
+    async def _recv_data(self):
+        data = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self._reader.readline(),
+                                              self._timeout)
+            except (OSError, asyncio.TimeoutError):
+                self._disconnect()
+
+            if not line:
+                self._disconnect()
+
+            data.append(line)
+            if line[3:4] != b'-':
+                break
+
+        return b''.join(data)
+
+    async def _recv(self):
+        code, resp = parse_response(await self._recv_data())
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f'\nResponse\ncode: {code}\n'
+                          f'msg: {decode_response(resp)}')
+        return code, resp
+
+    async def _send(self, message, to_base64=False):
+        message = message.encode()
+        if to_base64:
+            message = base64.b64encode(message)
+        await self._send_chunks((message, b'\r\n'))
+
+    async def _send_chunks(self, chunks):
+        try:
+            for chunk in chunks:
+                self._writer.write(chunk)
+                await asyncio.wait_for(self._writer.drain(), self._timeout)
+        except (OSError, asyncio.TimeoutError):
+            self._disconnect()
+
+    async def _send_msg_to_server(self, message, to_base64=False,
+                                  handle_resp=True):
+        logging.debug(f"Request: '{message}'")
+
+        await self._send(message, to_base64=to_base64)
+        if handle_resp:
+            code, resp = await self._recv()
+            self._handle_response_code(code, resp)
+            return code, resp
+
+    async def _ehlo(self):
+        code, resp = await self._send_msg_to_server(
+            f'EHLO {self._local_hostname}')
+        self._capabilities = SMTPCapabilities.from_response(resp)
+        CAPABILITIES.set(self._server, self._capabilities)
+
+    async def _auth_login(self, login, passwd):
+        await self._send_msg_to_server('AUTH LOGIN')
+        await self._send_msg_to_server(login, to_base64=True)
+        await self._send_msg_to_server(passwd, to_base64=True)
+
+    async def _send_body(self, mail):
+        await self._send_chunks(dot_stuff(mail.iter_chunks()))
+        await self._send_msg_to_server('\r\n.', handle_resp=False)
+        try:
+            code, resp = await self._recv()
+        except SMTPDisconnectedException as e:
+            raise SMTPDeliveryUnknownException(
+                'Connection lost before the server confirmed the mail') \
+                from e
+        self._handle_response_code(code, resp)
+
+    def _get_mail_from(self, mail):
+        return get_mail_from(self._login, mail, self.max_size)
+
+    async def _send_envelope(self, mail, recipients):
+        await self._send_msg_to_server(self._get_mail_from(mail))
+        responses = {}
+        for recipient in recipients:
+            await self._send_msg_to_server(f'RCPT TO:<{recipient}>',
+                                           handle_resp=False)
+            responses[recipient] = await self._recv()
+        return responses
+
+    async def _send_envelope_pipelined(self, mail, recipients):
+        commands = [self._get_mail_from(mail),
+                    *(f'RCPT TO:<{recipient}>' for recipient in recipients),
+                    'DATA']
+        await self._send_msg_to_server('\r\n'.join(commands),
+                                       handle_resp=False)
+
+        responses = [await self._recv() for _ in commands]
+        self._handle_response_code(*responses[0])
+        return dict(zip(recipients, responses[1:-1])), responses[-1]
+
+    def _get_refused(self, responses):
+        refused = get_refused(responses)
+        for recipient, (code, resp) in refused.items():
+            if code != TOO_MANY_RECIPIENTS:
+                logging.warning(
+                    f'Recipient {recipient} refused: {code} {resp}')
+        return refused
+
+    async def close(self):
+        if self._writer is None or self._writer.transport.is_closing():
+            return
+        try:
+            await self._send_msg_to_server('QUIT', handle_resp=False)
+        finally:
+            self._writer.close()
+
+    async def _send_transaction(self, mail, recipients):
+        if self._transactions > 0:
+            await self._send_msg_to_server('RSET')
+        if self._capabilities.pipelining:
+            responses, data_resp = \
+                await self._send_envelope_pipelined(mail, recipients)
+        else:
+            responses = await self._send_envelope(mail, recipients)
+            data_resp = None
+        refused = self._get_refused(responses)
+        if len(refused) == len(recipients):
+            await self._send_msg_to_server('RSET')
+            return refused
+
+        if data_resp is None:
+            await self._send_msg_to_server('DATA')
+        else:
+            self._handle_response_code(*data_resp)
+        await self._send_body(mail)
+        self._transactions += 1
+        return refused
+
+    async def send_mail(self, mail, bcc=None, exclude=()):
+        check_mail_size(mail, self.max_size)
+        recipients = RecipientSet(mail.recipients)
+        if bcc is not None:
+            recipients.update(bcc)
+        recipients.difference_update(exclude)
+        if not recipients:
+            return {}
+
+        delivered = []
+        refused = {}
+        batches = deque(recipients.split(self.max_recipients))
+        try:
+            while batches:
+                batch = batches.popleft()
+                batch_refused = await self._send_transaction(mail, batch)
+                refused.update(get_rejected(batch_refused))
+                accepted, deferred = get_batch_result(batch, batch_refused)
+                delivered.extend(accepted)
+                if deferred:
+                    logging.info('Deferring %d recipients to next '
+                                 'transaction', len(deferred))
+                    batches.appendleft(deferred)
+            if not delivered:
+                raise SMTPRecipientsRefusedException(refused)
+        except SMTPException as e:
+            e.delivered = delivered
+            e.refused = refused
+            raise
+        return refused
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            await self.close()
+        except SMTPDisconnectedException:
+            if exc_type is None:
+                raise
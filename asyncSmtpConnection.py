@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from collections import deque
+
+from asyncSmtp import AsyncSMTPClient
+from retry import RetryPolicy
+from smtp import SMTPDeliveryUnknownException, SMTPDisconnectedException, \
+    SMTPPermanentException, SMTPRecipientsRefusedException, \
+    SMTPTemporaryException
+from smtpConnection import ROUND_ROBIN, RelaySelector, get_relays, \
+    log_failed_mail
+
+
+class AsyncSMTPConnection:
+    def __init__(self, reconnection_count, login, passwd, server,
+                 disble_ssl, retry_policy=None, verify_tls=True,
+                 balance=ROUND_ROBIN, failure_threshold=None):
+        self._reconnection_count = reconnection_count
+        self._retry_policy = retry_policy
+        if retry_policy is None:
+            self._retry_policy = RetryPolicy()
+        self._relays = RelaySelector(get_relays(server), balance=balance,
+                                     failure_threshold=failure_threshold)
+        self._smtp_client_kwargs = {'login': login,
+                                    'passwd': passwd,
+                                    'disable_ssl': disble_ssl,
+                                    'verify_tls': verify_tls}
+
+    async def create_connection(self):
+        logging.info("Connecting to server")
+        tried = set()
+        for attempt in range(self._reconnection_count):
+            server = self._relays.choose(tried)
+            if server is None:
+                logging.info("All servers are marked unavailable")
+                return
+            if attempt > 0:
+                await asyncio.sleep(self._retry_policy.get_delay(attempt - 1))
+            try:
+                client = await AsyncSMTPClient(
+                    server=server, **self._smtp_client_kwargs).connect()
+            except SMTPDisconnectedException:
+                self._relays.record_failure(server)
+                tried.add(server)
+                logging.info(
+                    f"Try reconnecting to server {server[0]}:{server[1]} "
+                    f"({self._reconnection_count - attempt - 1}"
+                    " attempts left)")
+                continue
+            except BaseException:
+                self._relays.record_failure(server)
+                raise
+
+            self._relays.record_connected(server)
+            return client
+
+    async def _should_retry(self, attempts, kind, budget, exc):
+        attempts[kind] += 1
+        if attempts[kind] >= budget:
+            return False
+
+        delay = self._retry_policy.get_delay(attempts[kind] - 1)
+        logging.info(f'Retrying mail in {delay:.2f}s: {exc}')
+        await asyncio.sleep(delay)
+        return True
+
+    async def _send_session(self, smtp, mails, bcc, results, skip_failed):
+        try:
+            async with smtp:
+                while mails:
+                    index, mail, exclude = mails.popleft()
+                    try:
+                        results[index] = await smtp.send_mail(
+                            mail, bcc=bcc, exclude=exclude)
+                    except SMTPDeliveryUnknownException:
+                        raise
+                    except (SMTPDisconnectedException,
+                            SMTPTemporaryException) as e:
+                        mails.appendleft(
+                            (index, mail,
+                             [*exclude, *e.delivered, *e.refused]))
+                        raise
+                    except SMTPPermanentException as e:
+                        if not skip_failed:
+                            raise
+                        log_failed_mail(mail, e)
+                        results[index] = e
+                        if not isinstance(e, SMTPRecipientsRefusedException):
+                            return
+        finally:
+            self._relays.record_closed(smtp.server)
+
+    async def _send_worker(self, mails, bcc, results, skip_failed):
+        attempts = {'connect': 0, 'transient': 0}
+        while mails:
+            try:
+                smtp = await self.create_connection()
+            except SMTPTemporaryException as e:
+                if not await self._should_retry(
+                        attempts, 'transient',
+                        self._retry_policy.transient_attempts, e):
+                    raise
+                continue
+            if smtp is None:
+                raise SMTPDisconnectedException('Server is not available')
+            try:
+                await self._send_session(smtp, mails, bcc, results,
+                                         skip_failed)
+            except SMTPDeliveryUnknownException:
+                raise
+            except SMTPDisconnectedException as e:
+                if not await self._should_retry(
+                        attempts, 'connect', self._reconnection_count, e):
+                    raise
+            except SMTPTemporaryException as e:
+                if not await self._should_retry(
+                        attempts, 'transient',
+                        self._retry_policy.transient_attempts, e):
+                    raise
+
+    async def send_mails(self, mails, bcc=None, sessions=1,
+                         skip_failed=False):
+        mails = deque((index, mail, ()) for index, mail in enumerate(mails))
+        results = [None] * len(mails)
+        count = max(1, min(sessions, len(mails)))
+        workers = [asyncio.ensure_future(
+            self._send_worker(mails, bcc, results, skip_failed))
+            for _ in range(count)]
+        try:
+            await asyncio.gather(*workers)
+            return results
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
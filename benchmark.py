@@ -0,0 +1,258 @@
+import sys
+
+if sys.version_info[:2] < (3, 6):
+    print('This code need Python 3.6 or higher')
+    sys.exit(10)
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from os import path
+
+from mail import PART_CACHE, Mail, build_emails, get_attachments_content
+from metrics import MetricsAggregator
+from smtp import SMTPClient
+from smtpSink import SMTPSink
+
+BENCH_SENDER = 'bench@example.com'
+BENCH_PASSWORD = 'bench'
+MAIN_PATH = path.join(path.dirname(path.abspath(__file__)), 'main.py')
+DEFAULT_SIZES = [1, 64, 1024]
+DEFAULT_RECIPIENTS = [1, 10]
+MAIL_COUNT = 10000
+MAIL_PARTS = 10
+REGRESSION_THRESHOLD = 0.1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SMTP client benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='attachment sizes in KiB')
+    parser.add_argument('--recipients', type=int, nargs='+',
+                        default=DEFAULT_RECIPIENTS,
+                        help='recipient counts per mail')
+    parser.add_argument('--count', type=int, default=100,
+                        help='mails per case')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='artificial sink latency per reply in seconds')
+    parser.add_argument('--tls', action='store_true',
+                        help='use implicit TLS with a self-signed cert')
+    parser.add_argument('--no-chunking', dest='chunking',
+                        action='store_false', help='disable sink CHUNKING')
+    parser.add_argument('--cases', type=str, nargs='+',
+                        default=['mail', 'build', 'smtp', 'main'],
+                        choices=['mail', 'build', 'smtp', 'main'])
+    parser.add_argument('--mail-count', type=int, default=MAIL_COUNT,
+                        help='mails per Mail construction case')
+    parser.add_argument('--parts', type=int, default=MAIL_PARTS,
+                        help='attachments per mail in Mail construction '
+                             'case')
+    parser.add_argument('--memory', action='store_true',
+                        help='trace peak python allocations (slower)')
+    parser.add_argument('--save', type=str,
+                        help='write results to json file')
+    parser.add_argument('--baseline', type=str,
+                        help='compare results with saved json file')
+    parser.add_argument('--threshold', type=float,
+                        default=REGRESSION_THRESHOLD,
+                        help='allowed throughput drop against baseline')
+    return parser.parse_args()
+
+
+def make_attachment(directory, size_kib):
+    filename = path.join(directory, f'attachment-{size_kib}k.bin')
+    if not path.isfile(filename):
+        with open(filename, 'wb') as file:
+            file.write(os.urandom(size_kib * 1024))
+    return filename
+
+
+def get_recipients(count):
+    return [f'rcpt{i}@example.com' for i in range(count)]
+
+
+def get_max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(action, count, memory=False):
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    size = action()
+    elapsed = time.perf_counter() - start
+    result = {'messages': count,
+              'elapsed': elapsed,
+              'messages_per_sec': count / elapsed,
+              'mb_per_sec': size / 1024 ** 2 / elapsed,
+              'max_rss_mb': get_max_rss_mb()}
+    if memory:
+        result['peak_alloc_mb'] = tracemalloc.get_traced_memory()[1] / \
+            1024 ** 2
+        tracemalloc.stop()
+    return result
+
+
+def bench_mail(directory, recipients, args):
+    attachments = get_attachments_content(
+        [make_attachment(directory, i + 1) for i in range(args.parts)])
+    for _, content in attachments:
+        content.preload()
+    recipients = get_recipients(recipients)
+
+    def action():
+        size = 0
+        for i in range(args.mail_count):
+            mail = Mail(BENCH_SENDER, recipients, f'bench {i}',
+                        message=f'message {i}', attachments=attachments)
+            for chunk in mail.iter_chunks():
+                size += len(chunk)
+        return size
+
+    return measure(action, args.mail_count, memory=args.memory)
+
+
+def bench_build(directory, size_kib, recipients, args):
+    attachment = make_attachment(directory, size_kib)
+    recipients = get_recipients(recipients)
+
+    def action():
+        size = 0
+        for _ in range(args.count):
+            PART_CACHE.clear()
+            for mail in build_emails(BENCH_SENDER, recipients, 'bench',
+                                     'message', attachments=[attachment]):
+                size += sum(len(chunk) for chunk in mail.iter_chunks())
+        return size
+
+    return measure(action, args.count, memory=args.memory)
+
+
+def bench_smtp(sink, directory, size_kib, recipients, args):
+    attachment = make_attachment(directory, size_kib)
+    mail, = build_emails(BENCH_SENDER, get_recipients(recipients), 'bench',
+                         'message', attachments=[attachment])
+    metrics = MetricsAggregator()
+
+    def action():
+        with SMTPClient(BENCH_SENDER, BENCH_PASSWORD, server=sink.server,
+                        disable_ssl=not args.tls, metrics=metrics,
+                        verify_tls=False) as smtp:
+            for _ in range(args.count):
+                smtp.send_mail(mail)
+        return metrics.bytes_sent
+
+    result = measure(action, args.count, memory=args.memory)
+    result['phases'] = {phase: {key: stats[key]
+                                for key in ('count', 'p50', 'p95')}
+                        for phase, stats
+                        in metrics.as_dict()['phases'].items()}
+    return result
+
+
+def bench_main(sink, directory, size_kib, args):
+    attachment = make_attachment(directory, size_kib)
+    bulk = path.join(directory, f'bulk-{args.count}.csv')
+    with open(bulk, 'w') as file:
+        file.write('email\n')
+        file.writelines(f'{e}\n' for e in get_recipients(args.count))
+    message = path.join(directory, 'message.txt')
+    with open(message, 'w') as file:
+        file.write('message')
+
+    host, port = sink.server
+    command = [sys.executable, MAIN_PATH, '-l', BENCH_SENDER,
+               '--password', BENCH_PASSWORD, '--bulk', bulk, '-m', message,
+               '-a', attachment, '--server', f'{host}:{port}', '--silent']
+    command.append('--insecure' if args.tls else '--nossl')
+
+    received = sink.stats.bytes_received
+    start = time.perf_counter()
+    returncode = subprocess.Popen(command).wait()
+    elapsed = time.perf_counter() - start
+    if returncode != 0:
+        raise RuntimeError(f'main.py exited with status {returncode}')
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    size = sink.stats.bytes_received - received
+    return {'messages': args.count,
+            'elapsed': elapsed,
+            'messages_per_sec': args.count / elapsed,
+            'mb_per_sec': size / 1024 ** 2 / elapsed,
+            'max_rss_mb': usage.ru_maxrss / 1024}
+
+
+def run_cases(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, \
+            SMTPSink(tls=args.tls, latency=args.latency,
+                     chunking=args.chunking, keep_messages=False) as sink:
+        for recipients in args.recipients:
+            if 'mail' in args.cases:
+                results[f'mail/{args.parts}parts/{recipients}rcpt'] = \
+                    bench_mail(directory, recipients, args)
+        for size in args.sizes:
+            for recipients in args.recipients:
+                if 'build' in args.cases:
+                    results[f'build/{size}k/{recipients}rcpt'] = \
+                        bench_build(directory, size, recipients, args)
+                if 'smtp' in args.cases:
+                    results[f'smtp/{size}k/{recipients}rcpt'] = \
+                        bench_smtp(sink, directory, size, recipients, args)
+            if 'main' in args.cases:
+                results[f'main/{size}k/1rcpt'] = \
+                    bench_main(sink, directory, size, args)
+    return results
+
+
+def format_result(name, result, baseline=None):
+    line = f"{name:<24} {result['messages_per_sec']:>9.1f} msg/s " \
+           f"{result['mb_per_sec']:>8.2f} MB/s " \
+           f"rss {result['max_rss_mb']:>7.1f} MB"
+    if 'peak_alloc_mb' in result:
+        line += f" alloc {result['peak_alloc_mb']:>7.1f} MB"
+    if baseline is not None:
+        change = result['messages_per_sec'] / \
+            baseline['messages_per_sec'] - 1
+        line += f' {change:+.1%}'
+    for phase, stats in result.get('phases', {}).items():
+        line += f"\n    {phase:<10} p50 {stats['p50'] * 1000:.2f}ms " \
+                f"p95 {stats['p95'] * 1000:.2f}ms"
+    return line
+
+
+def get_regressions(results, baseline, threshold):
+    return [name for name, result in results.items()
+            if name in baseline and result['messages_per_sec'] <
+            baseline[name]['messages_per_sec'] * (1 - threshold)]
+
+
+def main():
+    args = parse_args()
+    results = run_cases(args)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    for name, result in results.items():
+        print(format_result(name, result, baseline.get(name)))
+
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    regressions = get_regressions(results, baseline, args.threshold)
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import csv
+import json
+from string import Template
+
+from mail import PART_CACHE, Mail, get_attachments_content
+
+RECIPIENT_FIELD = 'email'
+
+
+class BulkException(ValueError):
+    pass
+
+
+def iter_rows(file, filename):
+    if filename.endswith('.jsonl'):
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                raise BulkException(
+                    f'Line {number} of {filename} is not valid JSON: {e}')
+        return
+
+    reader = csv.DictReader(file)
+    try:
+        for row in reader:
+            yield reader.line_num, row
+    except csv.Error as e:
+        raise BulkException(f'Line {reader.line_num} of {filename}: {e}')
+
+
+def read_recipients(filename):
+    rows = []
+    with open(filename, newline='') as file:
+        for number, row in iter_rows(file, filename):
+            if not isinstance(row, dict) or \
+                    not isinstance(row.get(RECIPIENT_FIELD), str) or \
+                    not row[RECIPIENT_FIELD]:
+                raise BulkException(f"Line {number} of {filename} has no "
+                                    f"'{RECIPIENT_FIELD}' field")
+            rows.append(row)
+    return rows
+
+
+def build_bulk_emails(sender, rows, subject, message, attachments=None,
+                      enable_html=False):
+    attachments = get_attachments_content(attachments)
+    if attachments is not None:
+        for _, content in attachments:
+            if content.encoded_size <= PART_CACHE.max_part_size:
+                content.preload()
+
+    Mail.validate_emails([sender, *(row[RECIPIENT_FIELD] for row in rows)])
+    subject = Template(subject)
+    message = Template(message)
+    cache_text = message.pattern.search(message.template) is None
+
+    def iter_built():
+        for row in rows:
+            yield Mail(sender, [row[RECIPIENT_FIELD]],
+                       subject.safe_substitute(row),
+                       message=message.safe_substitute(row),
+                       attachments=attachments, enable_html=enable_html,
+                       cache_text=cache_text)
+
+    return iter_built()
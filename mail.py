@@ -1,10 +1,14 @@
 import base64
+import hashlib
+import logging
 import mimetypes
+import mmap
 import re
-import string
-import textwrap
-from os import path
-from random import choices
+import threading
+from collections import OrderedDict, deque
+from functools import lru_cache
+from os import path, stat
+from random import getrandbits
 
 
 class EmailValidationException(ValueError):
@@ -15,81 +19,395 @@ class AttachmentException(ValueError):
     pass
 
 
-def get_size(content):
-    return len(content) / (1024 ** 2)
+ENCODE_BLOCK_SIZE = 57 * 16 * 1024
+BASE64_LINE_SIZE = 57
+VALIDATION_CACHE_SIZE = 4096
+PREFETCH_BLOCKS = 2
+PREFETCH_BLOCK_SIZE = 16 * 1024 ** 2
+MAX_BLOCKS = 99999
 
+HEADER_TEMPLATE = 'Subject: {}\nFrom: {}\nTo: {}\n'
+BLOCK_TEMPLATE = 'Content-Type: {}\nMIME-Version: {}\n'
+BASE64_FIELDS = 'Content-Transfer-Encoding: base64\n'
+FILE_FIELDS_TEMPLATE = BASE64_FIELDS + \
+    'Content-Disposition: attachment; filename="{}"\n'
+BOUNDARY_TEMPLATE = '==============={:019d}=='
 
-def get_attachments_content(attachments, decode=True):
+
+def iter_encoded_range(filename, offset, size, block_size):
+    if size == 0:
+        return
+    with open(filename, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        end = offset + size
+        for start in range(offset, end, block_size):
+            block = data[start:min(start + block_size, end)]
+            yield memoryview(base64.encodebytes(block))
+
+
+def encode_range(filename, offset, size, block_size):
+    return b''.join(iter_encoded_range(filename, offset, size, block_size))
+
+
+class FileAttachment:
+    def __init__(self, filename, block_size=ENCODE_BLOCK_SIZE, offset=0,
+                 length=None):
+        self._filename = filename
+        self._block_size = max(block_size - block_size % BASE64_LINE_SIZE,
+                               BASE64_LINE_SIZE)
+        file_stat = stat(filename)
+        self._offset = min(offset, file_stat.st_size)
+        self._size = file_stat.st_size - self._offset
+        if length is not None:
+            self._size = min(self._size, length)
+        self._cache_key = 'file', path.abspath(filename), \
+            file_stat.st_mtime_ns, self._offset, self._size
+        self._encoded = None
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def cache_key(self):
+        return self._cache_key
+
+    @property
+    def preloaded(self):
+        return self._encoded is not None
+
+    @property
+    def encoded_size(self):
+        lines = -(-self._size // BASE64_LINE_SIZE)
+        return -(-self._size // 3) * 4 + lines
+
+    def preload(self):
+        if self._encoded is None:
+            self._encoded = encode_range(self._filename, self._offset,
+                                         self._size, self._block_size)
+        return self
+
+    def load(self, encoded):
+        self._encoded = encoded
+        return self
+
+    def iter_chunks(self):
+        if self._encoded is not None:
+            yield memoryview(self._encoded)
+        else:
+            yield from iter_encoded_range(self._filename, self._offset,
+                                          self._size, self._block_size)
+
+
+class PartCache:
+    def __init__(self, max_parts=256, max_size=32 * 1024 ** 2,
+                 max_part_size=4 * 1024 ** 2):
+        self._max_parts = max_parts
+        self._max_size = max_size
+        self._max_part_size = max_part_size
+        self._parts = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_part_size(self):
+        return self._max_part_size
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._parts)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._parts
+
+    @staticmethod
+    def _get_parts_size(parts):
+        return sum(len(e) if isinstance(e, bytes)
+                   else e.encoded_size if e.preloaded else 0
+                   for e in parts)
+
+    def _store(self, key, parts):
+        if any(isinstance(e, FileAttachment) and e.preloaded
+               and e.encoded_size > self._max_part_size for e in parts):
+            return
+        if key in self._parts:
+            self._size -= self._parts.pop(key)[1]
+        size = self._get_parts_size(parts)
+        if size > self._max_size:
+            return
+        self._parts[key] = parts, size
+        self._size += size
+        while len(self._parts) > self._max_parts or \
+                self._size > self._max_size:
+            _, (_, evicted_size) = self._parts.popitem(last=False)
+            self._size -= evicted_size
+
+    def _preload_shared(self, parts):
+        shared = [e for e in parts
+                  if isinstance(e, FileAttachment) and not e.preloaded
+                  and e.encoded_size <= self._max_part_size]
+        for content in shared:
+            content.preload()
+        return bool(shared)
+
+    def get(self, key, build):
+        with self._lock:
+            entry = self._parts.get(key)
+            if entry is not None:
+                self._parts.move_to_end(key)
+
+        if entry is None:
+            parts = build()
+            with self._lock:
+                if key not in self._parts:
+                    self._store(key, parts)
+            return parts
+
+        parts = entry[0]
+        if self._preload_shared(parts):
+            with self._lock:
+                if key in self._parts:
+                    self._store(key, parts)
+        return parts
+
+    def clear(self):
+        with self._lock:
+            self._parts.clear()
+            self._size = 0
+
+
+PART_CACHE = PartCache()
+
+
+def get_file_part_key(filename, content):
+    return (filename, *content.cache_key)
+
+
+def get_attachments_content(attachments):
     if attachments is None:
         return
-    result = []
-    for attachment in attachments:
-        with open(attachment, 'rb') as file:
-            content = file.read()
-        content = base64.b64encode(content)
-        if decode:
-            content = content.decode()
-        result.append((attachment, content))
+    return [(attachment, FileAttachment(attachment))
+            for attachment in attachments]
 
-    return result
 
+EXACT_PACKING_LIMIT = 10
 
-def build_emails(sender, recipients, subject, message, attachments=None,
-                 enable_html=False, max_attach_size=None):
-    if max_attach_size is None:
-        return [Mail(sender, recipients, subject, message=message,
-                     attachments=get_attachments_content(attachments),
-                     enable_html=enable_html)]
-    result = []
-    attach_blocks = []
-    attachments_sizes = []
 
-    attachments_content = get_attachments_content(attachments, decode=False)
-    for attachment, content in attachments_content:
-        size = get_size(content)
-        if size > max_attach_size:
-            raise AttachmentException(f'Attachment too big: {attachment}')
-
-        attachments_sizes.append((size, (attachment, content.decode())))
-    attachments_sizes = sorted(attachments_sizes)
-
-    current_block = []
-    current_size = 0
-    for size, attachment_info in attachments_sizes:
-        if current_size + size > max_attach_size:
-            attach_blocks.append(current_block)
-            current_block = []
-            current_size = 0
-
-        current_size += size
-        current_block.append(attachment_info)
-    if len(current_block) > 0:
-        attach_blocks.append(current_block)
-
-    for i, block in enumerate(attach_blocks):
-        suffix = f'<p><i>{i+1} of {len(attach_blocks)} ' \
-                 'attachment block</i></p>'
-        if i == 0:
-            mail = Mail(sender, recipients, subject, message=message,
-                        attachments=block, enable_html=enable_html)
+def _first_fit_decreasing(items, capacity):
+    blocks = []
+    for size, info in items:
+        for block in blocks:
+            if block[0] + size <= capacity:
+                block[0] += size
+                block[1].append(info)
+                break
         else:
-            mail = Mail(sender, recipients, subject, attachments=block)
+            blocks.append([size, [info]])
+    return [block for _, block in blocks]
+
+
+def _exact_packing(items, capacity, best):
+    best = [best]
+    loads = []
+    blocks = []
+
+    def place(i):
+        if len(blocks) >= len(best[0]):
+            return
+        if i == len(items):
+            best[0] = [list(block) for block in blocks]
+            return
+
+        size, info = items[i]
+        tried = set()
+        for j, load in enumerate(loads):
+            if load + size > capacity or load in tried:
+                continue
+            tried.add(load)
+            loads[j] += size
+            blocks[j].append(info)
+            place(i + 1)
+            blocks[j].pop()
+            loads[j] -= size
+
+        loads.append(size)
+        blocks.append([info])
+        place(i + 1)
+        loads.pop()
+        blocks.pop()
+
+    place(0)
+    return best[0]
+
+
+def pack_attachments(items, capacity):
+    items = sorted(((size, (i, info)) for i, (size, info) in enumerate(items)),
+                   key=lambda e: e[0], reverse=True)
+    blocks = _first_fit_decreasing(items, capacity)
+
+    lower_bound = -(-sum(size for size, _ in items) // capacity)
+    if len(blocks) > lower_bound and len(items) <= EXACT_PACKING_LIMIT:
+        blocks = _exact_packing(items, capacity, blocks)
+
+    blocks = sorted(sorted(block) for block in blocks)
+    return [[info for _, info in block] for block in blocks]
+
+
+def split_attachment(attachment, content, capacity):
+    name = f'{attachment}.000'
+    line_size = BASE64_LINE_SIZE // 3 * 4 + 1
+    lines = (capacity - Mail.get_file_part_overhead(name)) // line_size
+    if lines <= 0:
+        raise AttachmentException(f'Attachment too big: {attachment}')
+
+    fragment_size = lines * BASE64_LINE_SIZE
+    count = -(-content.size // fragment_size)
+    return [(f'{attachment}.{i + 1:03d}',
+             FileAttachment(attachment, offset=i * fragment_size,
+                            length=fragment_size))
+            for i in range(count)]
+
+
+def _get_attachment_blocks(attachments_content, max_attach_size,
+                           overhead=0):
+    attachments_sizes = []
+    leading_fragments = {}
+    capacity = int(max_attach_size * 1024 ** 2) - overhead
+    if capacity <= 0:
+        raise AttachmentException(
+            f'Mail size limit {max_attach_size} MiB is too small')
+    for attachment, content in attachments_content or ():
+        size = Mail.get_file_part_size(attachment, content)
+        if size <= capacity:
+            attachments_sizes.append((size, (attachment, content)))
+            continue
+
+        logging.info(f'Splitting {attachment} into fragments')
+        *fragments, last = split_attachment(attachment, content, capacity)
+        leading_fragments[last[0]] = fragments
+        attachments_sizes.append((Mail.get_file_part_size(*last), last))
+
+    blocks = []
+    for block in pack_attachments(attachments_sizes, capacity):
+        for filename, _ in block:
+            blocks.extend([fragment] for fragment
+                          in leading_fragments.get(filename, ()))
+        blocks.append(block)
+    return blocks or [[]]
+
+
+def _build_block_mail(sender, recipients, subject, message, block,
+                      enable_html, index, count):
+    if count is None:
+        return Mail(sender, recipients, subject, message=message,
+                    attachments=block, enable_html=enable_html)
+
+    suffix = f'<p><i>{index + 1} of {count} attachment block</i></p>'
+    if index == 0:
+        mail = Mail(sender, recipients, subject, message=message,
+                    attachments=block, enable_html=enable_html)
+    else:
+        mail = Mail(sender, recipients, subject, attachments=block)
+    mail.attach_text(suffix, enable_html=True)
+    return mail
+
+
+def _get_block_overhead(sender, recipients, subject, message, enable_html):
+    return max(_build_block_mail(sender, recipients, subject, message, None,
+                                 enable_html, index, MAX_BLOCKS).size
+               for index in (0, MAX_BLOCKS - 1))
+
+
+def _submit_encoding(executor, block):
+    budget = PREFETCH_BLOCK_SIZE
+    cache = Mail.part_cache
+    encodings = []
+    for filename, content in block or ():
+        if not isinstance(content, FileAttachment) or content.preloaded \
+                or content.encoded_size > budget:
+            continue
+        if cache is not None and \
+                get_file_part_key(filename, content) in cache:
+            continue
+        budget -= content.encoded_size
+        encodings.append((content, executor.submit(
+            encode_range, content.filename, content.offset, content.size,
+            content.block_size)))
+    return encodings
+
+
+def iter_emails(sender, recipients, subject, message, attachments=None,
+                enable_html=False, max_attach_size=None, executor=None,
+                prefetch=PREFETCH_BLOCKS):
+    Mail.validate_emails([sender, *recipients])
+    attachments_content = get_attachments_content(attachments)
+    count = None
+    blocks = [attachments_content]
+    if max_attach_size is not None:
+        overhead = _get_block_overhead(sender, recipients, subject, message,
+                                       enable_html)
+        blocks = _get_attachment_blocks(attachments_content, max_attach_size,
+                                        overhead)
+        count = len(blocks)
+
+    def build(index, block, encodings=()):
+        for content, future in encodings:
+            content.load(future.result())
+        return _build_block_mail(sender, recipients, subject, message, block,
+                                 enable_html, index, count)
+
+    def iter_built():
+        queued = deque(enumerate(blocks))
+        blocks.clear()
+        if executor is None:
+            while queued:
+                yield build(*queued.popleft())
+            return
+
+        pending = deque()
+        while queued or pending:
+            while queued and len(pending) < max(prefetch, 1):
+                index, block = queued.popleft()
+                pending.append((index, block,
+                                _submit_encoding(executor, block)))
+            yield build(*pending.popleft())
+
+    return iter_built()
 
-        mail.attach_text(suffix, enable_html=True)
-        result.append(mail)
 
-    return result
+def build_emails(sender, recipients, subject, message, attachments=None,
+                 enable_html=False, max_attach_size=None):
+    return list(iter_emails(sender, recipients, subject, message,
+                            attachments=attachments, enable_html=enable_html,
+                            max_attach_size=max_attach_size))
 
 
 class Mail:
     DELIMITER = ', '
+    part_cache = PART_CACHE
     EMAIL_REGEX = re.compile(
         r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
 
     def __init__(self, sender, recipients, subject, message=None,
                  attachments=None, enable_html=False,
-                 boundary=None):
-        self._mail = ''
+                 boundary=None, cache_text=True):
+        self._parts = []
         self._sender = sender
         self._recipients = recipients
         self.validate_emails([sender, *recipients])
@@ -97,74 +415,122 @@ class Mail:
         self._boundary = boundary
         if boundary is None:
             self._boundary = self._generate_boundary()
+        self._boundary_line = f'\n--{self._boundary}\n'.encode()
 
-        additional_fields = textwrap.dedent(f'''\
-                                Subject: {subject}
-                                From: {self._sender}
-                                To: {self.DELIMITER.join(recipients)}
-                                ''')
+        additional_fields = HEADER_TEMPLATE.format(
+            subject, self._sender, self.DELIMITER.join(recipients))
         self._attach_block(f'multipart/mixed; boundary="{self._boundary}"',
                            additional_fields=additional_fields,
                            add_boundary=False)
 
         if message is not None:
-            self.attach_text(message, enable_html=enable_html)
+            self.attach_text(message, enable_html=enable_html,
+                             cache=cache_text)
 
         if attachments is not None:
             for filename, content in attachments:
-                ctype, encoding = mimetypes.guess_type(filename)
-                if ctype is None or encoding is not None:
-                    ctype = "application/octet-stream"
-
-                filename = path.basename(filename)
-                additional_fields = textwrap.dedent(f'''\
-                    Content-Transfer-Encoding: base64
-                    Content-Disposition: attachment; filename="{filename}"
-                    ''')
-
-                self._attach_block(ctype, body=content,
-                                   additional_fields=additional_fields)
+                self.attach_file(filename, content)
 
     @staticmethod
     def _generate_boundary():
-        random_numbers = ''.join(choices(string.digits, k=19))
-        return f'==============={random_numbers}=='
+        return BOUNDARY_TEMPLATE.format(getrandbits(63))
+
+    @staticmethod
+    def _build_block(content_type, mime_version='1.0',
+                     additional_fields=None, body=None):
+        block = BLOCK_TEMPLATE.format(content_type, mime_version)
+        if additional_fields is not None:
+            block += additional_fields
+        if body is None:
+            return [block.encode()]
+
+        parts = [f'{block}\n'.encode()]
+        if isinstance(body, str):
+            body = body.encode()
+        parts.append(body)
+        if isinstance(body, bytes) and not body.endswith(b'\n'):
+            parts.append(b'\n')
+        return parts
 
     def _attach_block(self, content_type,
                       mime_version='1.0', additional_fields=None,
                       body=None, add_boundary=True):
         if add_boundary:
-            self._mail += textwrap.dedent(f'''\
-                                    
-                                    --{self._boundary}
-                                    ''')
-
-        self._mail += textwrap.dedent(f'''\
-                        Content-Type: {content_type}
-                        MIME-Version: {mime_version}
-                        ''')
-        if additional_fields is not None:
-            self._mail += additional_fields
-        if body is not None:
-            self._mail += textwrap.dedent(f'''\
-                            
-                            {body}
-                            ''')
-
-    def attach_text(self, text, enable_html=False):
+            self._add_boundary()
+        self._parts.extend(self._build_block(
+            content_type, mime_version=mime_version,
+            additional_fields=additional_fields, body=body))
+
+    def _add_boundary(self):
+        self._parts.append(self._boundary_line)
+
+    def _attach_cached(self, key, build):
+        self._add_boundary()
+        if self.part_cache is None:
+            self._parts.extend(build())
+        else:
+            self._parts.extend(self.part_cache.get(key, build))
+
+    @staticmethod
+    def _get_file_block_fields(filename):
+        ctype, encoding = mimetypes.guess_type(filename)
+        if ctype is None or encoding is not None:
+            ctype = "application/octet-stream"
+
+        return ctype, FILE_FIELDS_TEMPLATE.format(path.basename(filename))
+
+    @classmethod
+    def _build_file_block(cls, filename, content):
+        ctype, additional_fields = cls._get_file_block_fields(filename)
+        return cls._build_block(ctype, body=content,
+                                additional_fields=additional_fields)
+
+    @classmethod
+    def get_file_part_overhead(cls, filename):
+        ctype, additional_fields = cls._get_file_block_fields(filename)
+        header, = cls._build_block(ctype, additional_fields=additional_fields)
+        boundary = f'\n--{cls._generate_boundary()}\n'
+        return len(boundary) + len(header) + 1
+
+    @classmethod
+    def get_file_part_size(cls, filename, content):
+        return cls.get_file_part_overhead(filename) + content.encoded_size
+
+    def attach_file(self, filename, content):
+        def build():
+            return self._build_file_block(filename, content)
+
+        if isinstance(content, FileAttachment):
+            self._attach_cached(get_file_part_key(filename, content), build)
+        else:
+            self._add_boundary()
+            self._parts.extend(build())
+
+    def attach_text(self, text, enable_html=False, cache=True):
         text_type = 'html' if enable_html else 'plain'
-        text = base64.b64encode(text.encode()).decode()
-        transfer_enc = textwrap.dedent('''\
-                        Content-Transfer-Encoding: base64
-                        ''')
+        text = text.encode()
+
+        def build():
+            return self._build_block(f'text/{text_type}; charset="utf-8"',
+                                     body=base64.encodebytes(text),
+                                     additional_fields=BASE64_FIELDS)
+
+        if not cache:
+            self._add_boundary()
+            self._parts.extend(build())
+            return
+        self._attach_cached(('text', text_type, hashlib.sha1(text).digest()),
+                            build)
 
-        self._attach_block(f'text/{text_type}; charset="utf-8"', body=text,
-                           additional_fields=transfer_enc)
+    @staticmethod
+    @lru_cache(maxsize=VALIDATION_CACHE_SIZE)
+    def is_valid_email(email):
+        return Mail.EMAIL_REGEX.match(email) is not None
 
     @staticmethod
     def validate_emails(emails):
         for mail in emails:
-            if not Mail.EMAIL_REGEX.match(mail):
+            if not Mail.is_valid_email(mail):
                 raise EmailValidationException(f'Incorrect email: {mail}')
 
     @property
@@ -175,5 +541,22 @@ class Mail:
     def sender(self):
         return self._sender
 
+    @property
+    def size(self):
+        return sum(len(part) if isinstance(part, bytes)
+                   else part.encoded_size
+                   for part in self._parts) + len(self._closing())
+
+    def _closing(self):
+        return f'\n--{self._boundary}--\n'.encode()
+
+    def iter_chunks(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield memoryview(part)
+            else:
+                yield from part.iter_chunks()
+        yield memoryview(self._closing())
+
     def __str__(self):
-        return self._mail + f'\n--{self._boundary}--\n'
+        return b''.join(self.iter_chunks()).decode()
@@ -5,12 +5,26 @@ if sys.version_info[:2] < (3, 6):
     sys.exit(10)
 
 import argparse
+import asyncio
 import logging
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from getpass import getpass
 from smtp import SMTPException, SMTPDisconnectedException
-from mail import EmailValidationException, build_emails, AttachmentException
+from mail import EmailValidationException, build_emails, iter_emails, \
+    AttachmentException
 from os import path
-from smtpConnection import SMTPConnection
+from smtpConnection import LEAST_OUTSTANDING, ROUND_ROBIN, SMTPConnection
+from asyncSmtpConnection import AsyncSMTPConnection
+from bulk import BulkException, build_bulk_emails, read_recipients
+from spool import Spool, SpoolWorker
+from metrics import MetricsAggregator
+from smtpDaemon import DELIVERY_ERROR, NOT_FOUND_ERROR, UNAVAILABLE_ERROR, \
+    VALIDATION_ERROR, DaemonException, MailDaemon, build_request, submit
 
 
 def get_msg_from_file(msg_path):
@@ -27,8 +41,21 @@ def parse_args():
     main_parser = argparse.ArgumentParser(description='SMTP client')
     required_named = main_parser.add_argument_group('required arguments')
     required_named.add_argument('-l', '--login', type=str, required=True)
-    required_named.add_argument('-r', '--recipients', type=str, nargs='+',
-                                required=True)
+    recipients_group = required_named.add_mutually_exclusive_group(
+        required=True)
+    recipients_group.add_argument('-r', '--recipients', type=str, nargs='+')
+    recipients_group.add_argument('--bulk', type=str,
+                                  help='path to csv/jsonl recipient list '
+                                       "with 'email' field, subject and "
+                                       'message are rendered per row '
+                                       '($field placeholders)')
+    recipients_group.add_argument('--worker', action='store_true',
+                                  help='deliver mails queued in --spool '
+                                       'directory')
+    recipients_group.add_argument('--daemon', type=str, metavar='SOCKET',
+                                  help='keep authenticated sessions open '
+                                       'and send mails submitted to unix '
+                                       'socket')
 
     main_parser.add_argument('-m', '--message', type=str,
                              help='path to message file '
@@ -42,8 +69,12 @@ def parse_args():
                              help='hidden recipients')
     main_parser.add_argument('-a', '--attachments', type=str, nargs='+',
                              help='paths to attachments')
-    main_parser.add_argument('--server', type=str,
-                             help="smtp server in format 'host[:port]'")
+    main_parser.add_argument('--server', type=str, nargs='+',
+                             help="smtp servers in format "
+                                  "'host[:port][/weight]'")
+    main_parser.add_argument('--balance', type=str, default=ROUND_ROBIN,
+                             choices=[ROUND_ROBIN, LEAST_OUTSTANDING],
+                             help='how to spread sessions between servers')
     main_parser.add_argument('--sender', type=str,
                              help='return address')
     main_parser.add_argument('--password', type=str)
@@ -53,11 +84,47 @@ def parse_args():
                              help='disable logging')
     main_parser.add_argument('--nossl', action='store_true',
                              help='disable ssl')
+    main_parser.add_argument('--starttls', action='store_true',
+                             help='upgrade plain connection with STARTTLS '
+                                  '(default port 587)')
+    main_parser.add_argument('--insecure', dest='verify_tls',
+                             action='store_false',
+                             help='do not verify server TLS certificate')
     main_parser.add_argument('-eh', action='store_true',
                              help='enable html support')
     main_parser.add_argument('-rc', type=int, default=2,
                              help='reconnection count')
-    return main_parser.parse_args()
+    main_parser.add_argument('--async', dest='use_async', action='store_true',
+                             help='send mails with asyncio client')
+    main_parser.add_argument('--sessions', type=int, default=1,
+                             help='number of concurrent sessions')
+    main_parser.add_argument('--workers', type=int, default=0,
+                             help='encode attachments in a pool of worker '
+                                  'processes while sending')
+    main_parser.add_argument('--spool', type=str,
+                             help='queue mails to spool directory instead '
+                                  'of sending them')
+    main_parser.add_argument('--metrics', action='store_true',
+                             help='show per-phase protocol timings')
+    main_parser.add_argument('--submit', type=str, metavar='SOCKET',
+                             help='hand mail off to a running --daemon '
+                                  'instead of connecting to server')
+    args = main_parser.parse_args()
+    if args.worker and args.spool is None:
+        main_parser.error('--worker requires --spool')
+    if args.starttls and (args.nossl or args.use_async):
+        main_parser.error('--starttls cannot be used with --nossl or --async')
+    if args.bulk is not None and (args.maxattachsize is not None
+                                  or args.workers > 0):
+        main_parser.error('--bulk cannot be used with --maxattachsize '
+                          'or --workers')
+    if args.submit is not None and args.recipients is None:
+        main_parser.error('--submit requires --recipients')
+    if args.daemon is not None and (args.use_async or args.spool is not None
+                                    or args.submit is not None):
+        main_parser.error('--daemon cannot be used with --async, --spool '
+                          'or --submit')
+    return args
 
 
 def set_logging_level(args):
@@ -94,6 +161,12 @@ def check_attachments_paths(args):
                 sys.exit(4)
 
 
+def check_bulk_path(args):
+    if args.bulk is not None and not path.isfile(args.bulk):
+        logging.critical('Not found recipient list: {}'.format(args.bulk))
+        sys.exit(4)
+
+
 def get_sender(args):
     args.login = args.login.lower()
     sender = args.login
@@ -102,57 +175,258 @@ def get_sender(args):
     return sender
 
 
-def get_mails(sender, message, args):
+@contextmanager
+def no_executor():
+    yield None
+
+
+def get_executor(args):
+    if args.workers > 0:
+        return ProcessPoolExecutor(max_workers=args.workers)
+    return no_executor()
+
+
+def get_mails(sender, message, args, executor=None):
     try:
+        if args.bulk is not None:
+            return build_bulk_emails(sender, read_recipients(args.bulk),
+                                     args.subject, message,
+                                     attachments=args.attachments,
+                                     enable_html=args.eh)
+        if executor is not None:
+            return iter_emails(sender, args.recipients, args.subject,
+                               message, enable_html=args.eh,
+                               attachments=args.attachments,
+                               max_attach_size=args.maxattachsize,
+                               executor=executor)
         mails = build_emails(sender, args.recipients, args.subject,
                              message,
                              enable_html=args.eh, attachments=args.attachments,
                              max_attach_size=args.maxattachsize)
-    except (EmailValidationException, AttachmentException) as e:
+    except (EmailValidationException, AttachmentException,
+            BulkException) as e:
         logging.critical(e)
         sys.exit(1)
-    mails.reverse()
     return mails
 
 
+def parse_server(server, nossl, starttls=False):
+    weight = 1
+    if server.find('/') != -1:
+        server, weight = server.rsplit('/', 1)
+    if server.find(':') != -1:
+        host, port = server.split(':')
+    else:
+        host = server
+        port = 25 if nossl else 587 if starttls else 465
+    return host, int(port), int(weight)
+
+
 def get_server(args):
     server = args.server
     if server is not None:
-        if args.server.find(':') != -1:
-            host, port = args.server.split(':')
-        else:
-            host = args.server
-            port = 25 if args.nossl else 465
-        server = host, int(port)
+        server = [parse_server(e, args.nossl, args.starttls)
+                  for e in args.server]
     return server
 
 
+def check_max_attach_size(max_size, args):
+    if max_size is not None and args.maxattachsize is not None \
+            and args.maxattachsize * 1024 ** 2 > max_size:
+        logging.critical(f'Mail size limit {args.maxattachsize} MiB '
+                         f'exceeds server limit of {max_size} bytes')
+        sys.exit(1)
+
+
+MAIL_QUEUE_FACTOR = 2
+QUEUE_DONE = object()
+
+
+def produce_mails(build, mail_queue):
+    try:
+        for mail in build():
+            mail_queue.put(mail)
+    except BaseException as e:
+        mail_queue.put(e)
+    else:
+        mail_queue.put(QUEUE_DONE)
+
+
+def iter_queue(mail_queue):
+    while True:
+        item = mail_queue.get()
+        if item is QUEUE_DONE:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def start_pipeline(build, size):
+    mail_queue = queue.Queue(maxsize=size)
+    threading.Thread(target=produce_mails, args=(build, mail_queue),
+                     daemon=True).start()
+    return iter_queue(mail_queue)
+
+
+def get_connection(passwd, server, args, metrics=None):
+    return SMTPConnection(args.rc + 1, args.login, passwd, server,
+                          args.nossl, pool_size=args.sessions,
+                          balance=args.balance, metrics=metrics,
+                          starttls=args.starttls, verify_tls=args.verify_tls)
+
+
+def send_mails(mails, passwd, server, args):
+    metrics = MetricsAggregator() if args.metrics else None
+    conn = get_connection(passwd, server, args, metrics=metrics)
+    try:
+        with conn:
+            check_max_attach_size(conn.get_max_size(), args)
+            results = conn.send_mails(mails, bcc=args.bcc,
+                                      skip_failed=args.bulk is not None)
+        logging.debug(f'Connection stats: {conn.stats.as_dict()}')
+        if metrics is not None:
+            logging.info(f'Protocol metrics:\n{metrics.dump(histograms=True)}')
+        return results
+    except SMTPDisconnectedException:
+        logging.critical('Server is not available')
+        sys.exit(3)
+    except SMTPException as e:
+        logging.critical(e)
+        sys.exit(2)
+
+
+def send_mails_async(mails, passwd, server, args):
+    conn = AsyncSMTPConnection(args.rc + 1, args.login, passwd, server,
+                               args.nossl, verify_tls=args.verify_tls,
+                               balance=args.balance)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            conn.send_mails(mails, bcc=args.bcc, sessions=args.sessions,
+                            skip_failed=args.bulk is not None))
+    except SMTPDisconnectedException:
+        logging.critical('Server is not available')
+        sys.exit(3)
+    except SMTPException as e:
+        logging.critical(e)
+        sys.exit(2)
+    finally:
+        loop.close()
+
+
+def spool_mails(mails, args):
+    spool = Spool(args.spool)
+    count = 0
+    for count, mail in enumerate(mails, 1):
+        spool.submit(mail, bcc=args.bcc)
+    logging.info(f'Queued {count} mails to {args.spool}')
+
+
+def run_worker(passwd, server, args):
+    conn = get_connection(passwd, server, args)
+    with conn:
+        stats = SpoolWorker(Spool(args.spool), conn).run()
+    logging.info(f'Spool drained: {stats}')
+
+
+def run_daemon(passwd, server, sender, args):
+    conn = get_connection(passwd, server, args)
+    daemon = MailDaemon(conn, args.daemon, sender, bcc=args.bcc)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with conn:
+        try:
+            daemon.warm_up()
+        except SMTPDisconnectedException:
+            logging.critical('Server is not available')
+            sys.exit(3)
+        except SMTPException as e:
+            logging.critical(e)
+            sys.exit(2)
+        logging.info(f'Listening on {args.daemon}')
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    logging.info(f'Daemon stopped: {daemon.stats}')
+
+
+ERROR_EXIT_CODES = {VALIDATION_ERROR: 1,
+                    DELIVERY_ERROR: 2,
+                    UNAVAILABLE_ERROR: 3,
+                    NOT_FOUND_ERROR: 4}
+
+
+def submit_mail(sender, args):
+    request = build_request(args.recipients, subject=args.subject,
+                            message=get_message(args),
+                            attachments=args.attachments, bcc=args.bcc,
+                            sender=sender, enable_html=args.eh,
+                            max_attach_size=args.maxattachsize)
+    try:
+        response = submit(args.submit, request)
+    except (OSError, DaemonException) as e:
+        logging.critical(f'Daemon is not available: {e}')
+        sys.exit(3)
+    if response['status'] != 'ok':
+        logging.critical(response['error'])
+        if response['failed']:
+            total = response['sent'] + response['failed']
+            logging.critical(f"Sent {response['sent']} of {total} mails")
+        sys.exit(ERROR_EXIT_CODES.get(response.get('error_type'), 2))
+    for recipient, (code, resp) in response['refused'].items():
+        logging.warning(f'Recipient {recipient} refused: {code} {resp}')
+
+
 def main():
     args = parse_args()
     set_logging_level(args)
+    if args.submit is not None:
+        check_attachments_paths(args)
+        submit_mail(get_sender(args), args)
+        logging.info('Successfully send mail')
+        return
+    if args.daemon is not None:
+        sender = get_sender(args)
+        run_daemon(get_passwd(args), get_server(args), sender, args)
+        return
+    if args.worker:
+        get_sender(args)
+        run_worker(get_passwd(args), get_server(args), args)
+        return
+    if args.spool is not None:
+        message = get_message(args)
+        check_attachments_paths(args)
+        check_bulk_path(args)
+        spool_mails(get_mails(get_sender(args), message, args), args)
+        return
+
     passwd = get_passwd(args)
-    message = get_message(args)
     check_attachments_paths(args)
+    check_bulk_path(args)
     sender = get_sender(args)
-    mails = get_mails(sender, message, args)
     server = get_server(args)
 
-    logging.info('Sending message')
-    conn = SMTPConnection(args.rc + 1, args.login, passwd, server, args.nossl)
-    try:
-        smtp = conn.create_connection()
-        while mails:
-            if smtp is None:
-                logging.critical('Server is not available')
-                sys.exit(3)
-            try:
-                with smtp:
-                    smtp.send_mail(mails[-1], bcc=args.bcc)
-                    mails.pop()
-            except SMTPDisconnectedException:
-                smtp = conn.create_connection()
-    except SMTPException as e:
-        logging.critical(e)
+    with get_executor(args) as executor:
+        def build():
+            return get_mails(sender, get_message(args), args,
+                             executor=executor)
+
+        logging.info('Sending message')
+        start = time.monotonic()
+        if args.use_async:
+            results = send_mails_async(list(build()), passwd, server, args)
+        else:
+            mails = start_pipeline(build, args.sessions * MAIL_QUEUE_FACTOR)
+            results = send_mails(mails, passwd, server, args)
+        elapsed = time.monotonic() - start
+    failed = sum(isinstance(e, SMTPException) for e in results)
+    if args.bulk is not None:
+        sent = len(results) - failed
+        logging.info(f'Sent {sent} mails in {elapsed:.2f}s '
+                     f'({sent / max(elapsed, 1e-9):.1f} mails/s)')
+    if failed:
+        logging.critical(f'Failed to send {failed} of {len(results)} mails')
         sys.exit(2)
     logging.info('Successfully send mail')
 
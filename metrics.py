@@ -0,0 +1,148 @@
+import bisect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+CONNECT = 'connect'
+TLS = 'tls'
+GREETING = 'greeting'
+EHLO = 'ehlo'
+AUTH = 'auth'
+MAIL_FROM = 'mail_from'
+RCPT = 'rcpt'
+DATA = 'data'
+RESPONSE = 'response'
+PHASES = [CONNECT, TLS, GREETING, EHLO, AUTH, MAIL_FROM, RCPT, DATA,
+          RESPONSE]
+HISTOGRAM_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+                     0.1, 0.2, 0.5, 1, 2, 5, 10, 30]
+SAMPLE_WINDOW = 10000
+
+
+class SMTPMetrics:
+    def record_phase(self, phase, duration):
+        pass
+
+    def record_bytes(self, count):
+        pass
+
+    def record_response(self, code):
+        pass
+
+    @contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, time.perf_counter() - start)
+
+
+class Histogram:
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._samples = deque(maxlen=SAMPLE_WINDOW)
+        self._count = 0
+        self._total = 0
+        self._max = 0
+
+    @property
+    def count(self):
+        return self._count
+
+    def add(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._samples.append(value)
+        self._count += 1
+        self._total += value
+        self._max = max(self._max, value)
+
+    def get_percentile(self, percent):
+        samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1,
+                           int(len(samples) * percent / 100))]
+
+    def get_buckets(self):
+        bounds = [*self._buckets, float('inf')]
+        return list(zip(bounds, self._counts))
+
+    def as_dict(self):
+        return {'count': self._count,
+                'avg': self._total / self._count if self._count else None,
+                'p50': self.get_percentile(50),
+                'p95': self.get_percentile(95),
+                'p99': self.get_percentile(99),
+                'max': self._max}
+
+
+class MetricsAggregator(SMTPMetrics):
+    def __init__(self):
+        self._phases = {}
+        self._codes = {}
+        self._bytes_sent = 0
+        self._lock = threading.Lock()
+
+    @property
+    def bytes_sent(self):
+        return self._bytes_sent
+
+    @property
+    def codes(self):
+        with self._lock:
+            return dict(self._codes)
+
+    def get_histogram(self, phase):
+        return self._phases.get(phase)
+
+    def record_phase(self, phase, duration):
+        with self._lock:
+            if phase not in self._phases:
+                self._phases[phase] = Histogram()
+            self._phases[phase].add(duration)
+
+    def record_bytes(self, count):
+        with self._lock:
+            self._bytes_sent += count
+
+    def record_response(self, code):
+        with self._lock:
+            self._codes[code] = self._codes.get(code, 0) + 1
+
+    def _get_phases(self):
+        known = [phase for phase in PHASES if phase in self._phases]
+        return known + sorted(set(self._phases) - set(PHASES))
+
+    def as_dict(self):
+        with self._lock:
+            return {'phases': {phase: self._phases[phase].as_dict()
+                               for phase in self._get_phases()},
+                    'codes': dict(self._codes),
+                    'bytes_sent': self._bytes_sent}
+
+    def dump(self, histograms=False):
+        lines = []
+        with self._lock:
+            for phase in self._get_phases():
+                histogram = self._phases[phase]
+                stats = histogram.as_dict()
+                lines.append(
+                    f"{phase:<10} n={stats['count']:<6} "
+                    f"avg={stats['avg'] * 1000:.1f}ms "
+                    f"p50={stats['p50'] * 1000:.1f}ms "
+                    f"p95={stats['p95'] * 1000:.1f}ms "
+                    f"p99={stats['p99'] * 1000:.1f}ms "
+                    f"max={stats['max'] * 1000:.1f}ms")
+                if not histograms:
+                    continue
+                for bound, count in histogram.get_buckets():
+                    if count:
+                        lines.append(f'  <= {bound * 1000:g}ms: {count}')
+            codes = ' '.join(f'{code}x{count}'
+                             for code, count in sorted(self._codes.items()))
+            lines.append(f'codes: {codes}')
+            lines.append(f'bytes sent: {self._bytes_sent}')
+        return '\n'.join(lines)
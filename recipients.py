@@ -0,0 +1,68 @@
+from mail import Mail
+
+MAX_RECIPIENTS = 100
+
+
+def get_domain(address):
+    return address.rpartition('@')[2].lower()
+
+
+def get_address_key(address):
+    local, _, domain = address.rpartition('@')
+    return f'{local}@{domain.lower()}'
+
+
+class RecipientSet:
+    def __init__(self, recipients=()):
+        self._recipients = {}
+        self.update(recipients)
+
+    def add(self, address):
+        key = get_address_key(address)
+        if key not in self._recipients:
+            Mail.validate_emails((address,))
+            self._recipients[key] = address
+
+    def update(self, recipients):
+        for address in recipients:
+            self.add(address)
+
+    def discard(self, address):
+        self._recipients.pop(get_address_key(address), None)
+
+    def difference_update(self, recipients):
+        for address in recipients:
+            self.discard(address)
+
+    def get_domains(self):
+        domains = {}
+        for address in self._recipients.values():
+            domains.setdefault(get_domain(address), []).append(address)
+        return domains
+
+    def split(self, max_recipients=MAX_RECIPIENTS):
+        if max_recipients is None or len(self) <= max_recipients:
+            return [list(self)]
+        batches = []
+        batch = []
+        for addresses in self.get_domains().values():
+            if batch and len(batch) + len(addresses) > max_recipients:
+                batches.append(batch)
+                batch = []
+            for address in addresses:
+                if len(batch) == max_recipients:
+                    batches.append(batch)
+                    batch = []
+                batch.append(address)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __contains__(self, address):
+        return get_address_key(address) in self._recipients
+
+    def __iter__(self):
+        return iter(self._recipients.values())
+
+    def __len__(self):
+        return len(self._recipients)
@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+from collections import deque
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+LATENCY_WINDOW = 1000
+
+
+class RetryPolicy:
+    def __init__(self, base_delay=0.5, max_delay=30, multiplier=2,
+                 jitter=0.5, connect_attempts=3, transient_attempts=3,
+                 sleep=time.sleep):
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._multiplier = multiplier
+        self._jitter = jitter
+        self._connect_attempts = connect_attempts
+        self._transient_attempts = transient_attempts
+        self._sleep = sleep
+
+    @property
+    def connect_attempts(self):
+        return self._connect_attempts
+
+    @property
+    def transient_attempts(self):
+        return self._transient_attempts
+
+    def get_delay(self, attempt):
+        delay = min(self._max_delay,
+                    self._base_delay * self._multiplier ** attempt)
+        return delay * (1 - self._jitter * random.random())
+
+    def wait(self, attempt):
+        delay = self.get_delay(attempt)
+        self._sleep(delay)
+        return delay
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30,
+                 clock=time.monotonic):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._get_state()
+
+    def _get_state(self):
+        if self._opened_at is None:
+            return CLOSED
+        now = self._clock()
+        if self._probe_started_at is not None and \
+                now - self._probe_started_at < self._reset_timeout:
+            return OPEN
+        if now - self._opened_at >= self._reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self._get_state()
+            if state == HALF_OPEN:
+                self._probe_started_at = self._clock()
+            return state != OPEN
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probe_started_at is not None or \
+                    self._get_state() == HALF_OPEN or \
+                    self._failures >= self._failure_threshold:
+                self._opened_at = self._clock()
+            self._probe_started_at = None
+
+
+class RetryStats:
+    def __init__(self):
+        self._counters = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+
+    def record_latency(self, name, duration):
+        with self._lock:
+            if name not in self._latencies:
+                self._latencies[name] = deque(maxlen=LATENCY_WINDOW)
+            self._latencies[name].append(duration)
+
+    @staticmethod
+    def _summarize(latencies):
+        latencies = sorted(latencies)
+        return {'count': len(latencies),
+                'avg': sum(latencies) / len(latencies),
+                'p50': latencies[len(latencies) // 2],
+                'p95': latencies[min(len(latencies) - 1,
+                                     int(len(latencies) * 0.95))],
+                'max': latencies[-1]}
+
+    def as_dict(self):
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'latencies': {name: self._summarize(latencies)
+                                  for name, latencies
+                                  in self._latencies.items()}}
@@ -1,15 +1,34 @@
 import base64
 import logging
+import re
 import socket
 import ssl
+import threading
+import time
+from collections import deque
+from itertools import chain
 
-from mail import Mail
+from metrics import AUTH, CONNECT, DATA, EHLO, GREETING, MAIL_FROM, \
+    RCPT, RESPONSE, TLS, SMTPMetrics
+from recipients import MAX_RECIPIENTS, RecipientSet
 
 SMTP_SERVER = ('smtp.gmail.com', 465)
+SMTP_STARTTLS_SERVER = ('smtp.gmail.com', 587)
+LOCAL_HOSTNAME = 'owrld'
+BDAT_CHUNK_SIZE = 1024 ** 2
+BDAT_WINDOW = 4
+DOT_LINE_RE = re.compile(rb'\n\.')
+SEND_BATCH_SIZE = 1024 ** 2
+COALESCE_SIZE = 16 * 1024
+IOV_MAX = 1024
+DATA_END = b'\r\n.\r\n'
+RECV_BUFFER_SIZE = 64 * 1024
+TOO_MANY_RECIPIENTS = 452
 
 
 class SMTPException(Exception):
-    pass
+    delivered = ()
+    refused = {}
 
 
 class SMTPTemporaryException(SMTPException):
@@ -24,98 +43,545 @@ class SMTPDisconnectedException(SMTPException):
     pass
 
 
+class SMTPDeliveryUnknownException(SMTPDisconnectedException):
+    pass
+
+
+class SMTPRecipientsRefusedException(SMTPPermanentException):
+    def __init__(self, recipients):
+        super().__init__(f'All recipients were refused: {recipients}')
+        self.recipients = recipients
+
+
+def parse_response(data):
+    try:
+        code = int(data[:3])
+    except ValueError:
+        code = -1
+
+    return code, data
+
+
+def decode_response(data):
+    return data[4:].decode(errors='replace').strip()
+
+
+def get_response_exception(code, resp):
+    code_type = code // 100
+    if code_type > 3:
+        resp = decode_response(resp)
+        return SMTPTemporaryException(resp) if code_type == 4 \
+            else SMTPPermanentException(resp)
+
+
+def get_refused(responses):
+    return {recipient: (code, decode_response(resp))
+            for recipient, (code, resp) in responses.items()
+            if code // 100 != 2}
+
+
+def get_deferred(refused):
+    return [recipient for recipient, (code, _) in refused.items()
+            if code == TOO_MANY_RECIPIENTS]
+
+
+def get_batch_result(batch, refused):
+    accepted = [recipient for recipient in batch if recipient not in refused]
+    deferred = get_deferred(refused)
+    if deferred and not accepted:
+        raise SMTPTemporaryException(f'Too many recipients: {refused}')
+    return accepted, deferred
+
+
+def get_rejected(refused):
+    return {recipient: response for recipient, response in refused.items()
+            if response[0] != TOO_MANY_RECIPIENTS}
+
+
+def is_certificate_error(exc):
+    return isinstance(exc, ssl.CertificateError) or \
+        getattr(exc, 'reason', None) == 'CERTIFICATE_VERIFY_FAILED'
+
+
+def get_max_size(extensions):
+    try:
+        return int(extensions['SIZE']) or None
+    except (KeyError, ValueError):
+        return None
+
+
+def get_max_recipients(extensions):
+    for param in extensions.get('LIMITS', '').split():
+        key, _, value = param.partition('=')
+        if key.upper() == 'RCPTMAX':
+            try:
+                return int(value) or None
+            except ValueError:
+                return None
+
+
+def check_mail_size(mail, max_size):
+    if max_size is not None and mail.size > max_size:
+        raise SMTPPermanentException(
+            f'Mail size {mail.size} exceeds server limit {max_size}')
+
+
+def get_mail_from(login, mail, max_size):
+    if max_size is None:
+        return f'MAIL FROM:<{login}>'
+    return f'MAIL FROM:<{login}> SIZE={mail.size}'
+
+
+def dot_stuff(chunks):
+    line_start = True
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if line_start and chunk[:1] == b'.':
+            yield b'.'
+        if DOT_LINE_RE.search(chunk) is None:
+            yield chunk
+        else:
+            yield DOT_LINE_RE.sub(b'\n..', chunk)
+        line_start = chunk[-1:] == b'\n'
+
+
+def send_buffers(sock, buffers):
+    buffers = [memoryview(e) for e in buffers if len(e)]
+    start = 0
+    while start < len(buffers):
+        sent = sock.sendmsg(buffers[start:start + IOV_MAX])
+        while sent:
+            if sent >= len(buffers[start]):
+                sent -= len(buffers[start])
+                start += 1
+            else:
+                buffers[start] = buffers[start][sent:]
+                sent = 0
+
+
+def coalesce(buffers):
+    small = []
+    for buffer in buffers:
+        if len(buffer) < COALESCE_SIZE:
+            small.append(buffer)
+            continue
+        if small:
+            yield b''.join(small)
+            small = []
+        yield buffer
+    if small:
+        yield b''.join(small)
+
+
+class FileRange:
+    def __init__(self, filename, offset, size):
+        self._filename = filename
+        self._offset = offset
+        self._size = size
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def offset(self):
+        return self._offset
+
+    def __len__(self):
+        return self._size
+
+
+def rechunk(chunks, size):
+    buffer = bytearray()
+    for chunk in chunks:
+        chunk = memoryview(chunk)
+        if buffer:
+            needed = size - len(buffer)
+            buffer += chunk[:needed]
+            chunk = chunk[needed:]
+            if len(buffer) < size:
+                continue
+            yield buffer
+            buffer = bytearray()
+
+        while len(chunk) >= size:
+            yield chunk[:size]
+            chunk = chunk[size:]
+        buffer += chunk
+    if buffer:
+        yield buffer
+
+
+def create_ssl_context(verify=True):
+    if verify:
+        return ssl.create_default_context()
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class TLSSessionCache:
+    def __init__(self, context=None, verify=True):
+        self._context = context
+        self._verify = verify
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def context(self):
+        with self._lock:
+            if self._context is None:
+                self._context = create_ssl_context(verify=self._verify)
+            return self._context
+
+    def get(self, server):
+        with self._lock:
+            return self._sessions.get(server)
+
+    def set(self, server, session):
+        if session is None:
+            return
+        with self._lock:
+            self._sessions[server] = session
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+
+TLS_SESSIONS = TLSSessionCache()
+INSECURE_TLS_SESSIONS = TLSSessionCache(verify=False)
+
+
+class ResponseReader:
+    def __init__(self, sock, buffer_size=RECV_BUFFER_SIZE):
+        self._sock = sock
+        self._buffer = bytearray(buffer_size)
+        self._data = bytearray()
+        self._replies = deque()
+
+    @property
+    def pending(self):
+        return len(self._replies)
+
+    def _parse(self):
+        start = end = 0
+        while True:
+            newline = self._data.find(b'\n', end)
+            if newline == -1:
+                break
+            line_start, end = end, newline + 1
+            if self._data[line_start + 3:line_start + 4] != b'-':
+                self._replies.append(bytes(self._data[start:end]))
+                start = end
+        del self._data[:start]
+
+    def _fill(self):
+        count = self._sock.recv_into(self._buffer)
+        if count == 0:
+            raise ConnectionResetError('Connection closed by server')
+        self._data += memoryview(self._buffer)[:count]
+        self._parse()
+
+    def read_reply(self):
+        while not self._replies:
+            self._fill()
+        return self._replies.popleft()
+
+    def read_replies(self, count):
+        while len(self._replies) < count:
+            self._fill()
+        return [self._replies.popleft() for _ in range(count)]
+
+
+def parse_extensions(resp):
+    extensions = {}
+    for line in resp.splitlines()[1:]:
+        keyword, _, params = line[4:].partition(' ')
+        extensions[keyword.upper()] = params.strip()
+    return extensions
+
+
+class SMTPCapabilities:
+    def __init__(self, extensions=None):
+        self._extensions = {} if extensions is None else extensions
+        self._max_size = get_max_size(self._extensions)
+        self._max_recipients = get_max_recipients(self._extensions)
+        mechanisms = self._extensions.get('AUTH', '').split()
+        for keyword, params in self._extensions.items():
+            if keyword.startswith('AUTH='):
+                mechanisms += [keyword[5:], *params.split()]
+        self._auth_mechanisms = frozenset(e.upper() for e in mechanisms)
+
+    @classmethod
+    def from_response(cls, resp):
+        return cls(parse_extensions(decode_response(resp)))
+
+    @property
+    def extensions(self):
+        return self._extensions
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def max_recipients(self):
+        return self._max_recipients
+
+    @property
+    def pipelining(self):
+        return 'PIPELINING' in self._extensions
+
+    @property
+    def chunking(self):
+        return 'CHUNKING' in self._extensions
+
+    @property
+    def eightbitmime(self):
+        return '8BITMIME' in self._extensions
+
+    @property
+    def smtputf8(self):
+        return 'SMTPUTF8' in self._extensions
+
+    @property
+    def starttls(self):
+        return 'STARTTLS' in self._extensions
+
+    @property
+    def auth_mechanisms(self):
+        return self._auth_mechanisms
+
+    def __contains__(self, keyword):
+        return keyword in self._extensions
+
+
+class CapabilityCache:
+    def __init__(self):
+        self._capabilities = {}
+        self._lock = threading.Lock()
+
+    def get(self, server):
+        with self._lock:
+            return self._capabilities.get(server)
+
+    def set(self, server, capabilities):
+        with self._lock:
+            self._capabilities[server] = capabilities
+
+    def clear(self):
+        with self._lock:
+            self._capabilities.clear()
+
+
+CAPABILITIES = CapabilityCache()
+
+
 class SMTPClient:
-    def __init__(self, login, passwd, server=None, disable_ssl=False):
-        self._server = SMTP_SERVER if server is None else server
+    def __init__(self, login, passwd, server=None, disable_ssl=False,
+                 chunk_size=BDAT_CHUNK_SIZE, metrics=None, starttls=False,
+                 tls_sessions=None, local_hostname=LOCAL_HOSTNAME,
+                 capabilities_cache=None, max_recipients=MAX_RECIPIENTS,
+                 verify_tls=True):
+        self._server = server
+        if server is None:
+            self._server = SMTP_STARTTLS_SERVER if starttls else SMTP_SERVER
         self._disable_ssl = disable_ssl
-        self._sock_file = None
+        self._starttls = starttls
+        self._tls_sessions = tls_sessions
+        if tls_sessions is None:
+            self._tls_sessions = TLS_SESSIONS if verify_tls \
+                else INSECURE_TLS_SESSIONS
+        self._chunk_size = chunk_size
+        self._reader = None
         self._login = login
         self._passwd = passwd
+        self._transactions = 0
+        self._max_recipients = max_recipients
+        self._local_hostname = local_hostname
+        self._capabilities = SMTPCapabilities()
+        self._capabilities_cache = CAPABILITIES if capabilities_cache is None \
+            else capabilities_cache
+        self._created_at = time.monotonic()
+        self._metrics = SMTPMetrics() if metrics is None else metrics
         self._connect()
 
     @property
     def server(self):
         return self._server
 
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def capabilities(self):
+        return self._capabilities
+
+    @property
+    def extensions(self):
+        return self._capabilities.extensions
+
+    @property
+    def tls_session_reused(self):
+        return bool(getattr(self._socket, 'session_reused', False))
+
+    @property
+    def max_size(self):
+        return self._capabilities.max_size
+
+    @property
+    def max_recipients(self):
+        limits = [e for e in (self._max_recipients,
+                              self._capabilities.max_recipients)
+                  if e is not None]
+        return min(limits, default=None)
+
+    @property
+    def messages_sent(self):
+        return self._transactions
+
+    @property
+    def age(self):
+        return time.monotonic() - self._created_at
+
     def _connect(self):
-        self._create_sock(self._server, self._disable_ssl)
+        self._create_sock(self._server,
+                          self._disable_ssl or self._starttls)
         self._ehlo()
+        if self._starttls and not self._disable_ssl:
+            self._start_tls()
         self._auth_login(self._login, self._passwd)
+        if isinstance(self._socket, ssl.SSLSocket):
+            self._tls_sessions.set(self._server, self._socket.session)
 
     def _disconnect(self):
         self._socket.close()
         raise SMTPDisconnectedException('Server is not available')
 
+    def _handshake(self):
+        try:
+            with self._metrics.timed(TLS):
+                self._socket.do_handshake()
+        except (ssl.CertificateError, socket.error) as e:
+            if not is_certificate_error(e):
+                self._disconnect()
+            self._socket.close()
+            raise SMTPPermanentException(
+                f'TLS certificate verification failed: {e}')
+
     def _create_sock(self, server, disable_ssl):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.settimeout(7)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._use_sendmsg = disable_ssl and hasattr(self._socket, 'sendmsg')
         if not disable_ssl:
-            self._socket = ssl.wrap_socket(self._socket,
-                                           ssl_version=ssl.PROTOCOL_SSLv23)
+            self._wrap_socket()
 
         try:
-            self._socket.connect(server)
+            with self._metrics.timed(CONNECT):
+                self._socket.connect(server)
         except socket.error:
             self._disconnect()
+        if not disable_ssl:
+            self._handshake()
+
+        with self._metrics.timed(GREETING):
+            self._recv_data()
 
-        self._recv_data(sock=self._socket)
+    def _wrap_socket(self):
+        self._socket = self._tls_sessions.context.wrap_socket(
+            self._socket, server_hostname=self._server[0],
+            do_handshake_on_connect=False,
+            session=self._tls_sessions.get(self._server))
+        self._use_sendmsg = False
+        self._reader = None
+
+    def _start_tls(self):
+        if not self._capabilities.starttls:
+            self._socket.close()
+            raise SMTPPermanentException('Server does not support STARTTLS')
+        self._send_msg_to_server('STARTTLS')
+        self._wrap_socket()
+        self._handshake()
+        self._ehlo()
 
     def _handle_response_code(self, code, resp):
-        code_type = code // 100
-        if code_type > 3:
+        exc = get_response_exception(code, resp)
+        if exc is not None:
             self._socket.close()
-            exc = SMTPTemporaryException(resp) if code_type == 4 \
-                else SMTPPermanentException(resp)
             raise exc
 
-    def _recv_data(self, sock=None):
-        sock = sock if sock is not None else self._socket
-        if self._sock_file is None:
-            self._sock_file = sock.makefile('rb')
-        data = []
-        while True:
-            try:
-                line = self._sock_file.readline()
-            except OSError:
-                self._disconnect()
+    def _get_reader(self):
+        if self._reader is None:
+            self._reader = ResponseReader(self._socket)
+        return self._reader
 
-            if not line:
-                self._disconnect()
-
-            data.append(line)
-            if line[3:4] != b'-':
-                break
-
-        return b''.join(data)
-
-    def _recv(self):
+    def _recv_data(self, count=None):
         try:
-            data = self._recv_data()
-        except socket.error:
+            if count is None:
+                return self._get_reader().read_reply()
+            return self._get_reader().read_replies(count)
+        except OSError:
             self._disconnect()
 
-        try:
-            code = int(data[:3])
-        except ValueError:
-            code = -1
-
-        resp = data[4:].decode().strip()
-        logging.debug(f'\nResponse\ncode: {code}\nmsg: {resp}')
+    def _parse_reply(self, data):
+        code, resp = parse_response(data)
+        self._metrics.record_response(code)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Response %s: %s', code, decode_response(resp))
         return code, resp
 
+    def _recv(self):
+        return self._parse_reply(self._recv_data())
+
+    def _recv_many(self, count):
+        return [self._parse_reply(data) for data in self._recv_data(count)]
+
     def _send(self, message, to_base64=False):
         message = message.encode()
         if to_base64:
             message = base64.b64encode(message)
-        message += b'\r\n'
+        self._send_chunks((message, b'\r\n'))
 
+    def _write(self, buffers):
+        try:
+            if self._use_sendmsg:
+                send_buffers(self._socket, buffers)
+            else:
+                for buffer in coalesce(buffers):
+                    self._socket.sendall(buffer)
+        except socket.error:
+            self._disconnect()
+        self._metrics.record_bytes(sum(len(e) for e in buffers))
+
+    def _send_chunks(self, chunks):
+        batch = []
+        batch_size = 0
+        for chunk in chunks:
+            batch.append(chunk)
+            batch_size += len(chunk)
+            if batch_size >= SEND_BATCH_SIZE or len(batch) >= IOV_MAX:
+                self._write(batch)
+                batch = []
+                batch_size = 0
+        if batch:
+            self._write(batch)
+
+    def _send_file(self, file_range):
         try:
-            self._socket.sendall(message)
+            with open(file_range.filename, 'rb') as file:
+                self._socket.sendfile(file, file_range.offset,
+                                      len(file_range))
         except socket.error:
             self._disconnect()
+        self._metrics.record_bytes(len(file_range))
 
     def _send_msg_to_server(self, message, to_base64=False, handle_resp=True):
-        logging.debug(f"Request: '{message}'")
+        logging.debug("Request: '%s'", message)
 
         self._send(message, to_base64=to_base64)
         if handle_resp:
@@ -124,39 +590,194 @@ class SMTPClient:
             return code, resp
 
     def _ehlo(self):
-        self._send_msg_to_server('EHLO owrld')
+        with self._metrics.timed(EHLO):
+            code, resp = self._send_msg_to_server(
+                f'EHLO {self._local_hostname}')
+        self._capabilities = SMTPCapabilities.from_response(resp)
+        self._capabilities_cache.set(self._server, self._capabilities)
 
     def _auth_login(self, login, passwd):
-        self._send_msg_to_server('AUTH LOGIN')
-        self._send_msg_to_server(login, to_base64=True)
-        self._send_msg_to_server(passwd, to_base64=True)
-
-    def _mail_from(self):
-        self._send_msg_to_server(f'MAIL FROM:<{self._login}>')
+        with self._metrics.timed(AUTH):
+            if 'PLAIN' in self._capabilities.auth_mechanisms:
+                token = base64.b64encode(f'\0{login}\0{passwd}'.encode())
+                self._send_msg_to_server(f'AUTH PLAIN {token.decode()}')
+                return
+            self._send_msg_to_server('AUTH LOGIN')
+            self._send_msg_to_server(login, to_base64=True)
+            self._send_msg_to_server(passwd, to_base64=True)
+
+    def _get_mail_from(self, mail):
+        return get_mail_from(self._login, mail, self.max_size)
+
+    def _mail_from(self, mail):
+        with self._metrics.timed(MAIL_FROM):
+            self._send_msg_to_server(self._get_mail_from(mail))
 
     def _rcpt_to(self, address):
-        self._send_msg_to_server(f'RCPT TO:<{address}>')
+        with self._metrics.timed(RCPT):
+            self._send_msg_to_server(f'RCPT TO:<{address}>',
+                                     handle_resp=False)
+            return self._recv()
 
-    def _data(self, data):
-        self._send_msg_to_server('DATA')
-        self._send(data)
-        self._send('.')
-        self._recv()
+    def _recv_final_replies(self, count=1):
+        try:
+            replies = self._recv_many(count)
+        except SMTPDisconnectedException as e:
+            raise SMTPDeliveryUnknownException(
+                'Connection lost before the server confirmed the mail') \
+                from e
+        for code, resp in replies:
+            self._handle_response_code(code, resp)
+
+    def _send_body(self, mail):
+        body_path = getattr(mail, 'path', None)
+        with self._metrics.timed(DATA):
+            if body_path is not None and getattr(mail, 'dot_safe', False):
+                self._send_file(FileRange(body_path, 0, mail.size))
+                self._send_chunks((DATA_END,))
+            else:
+                self._send_chunks(chain(dot_stuff(mail.iter_chunks()),
+                                        (DATA_END,)))
+        with self._metrics.timed(RESPONSE):
+            self._recv_final_replies()
+
+    def _send_bdat(self, chunk, last=False):
+        command = f'BDAT {len(chunk)} LAST' if last else f'BDAT {len(chunk)}'
+        logging.debug("Request: '%s'", command)
+        command = f'{command}\r\n'.encode()
+        if isinstance(chunk, FileRange):
+            self._send_chunks((command,))
+            self._send_file(chunk)
+        else:
+            self._send_chunks((command, chunk))
+
+    def _iter_bdat_chunks(self, mail):
+        body_path = getattr(mail, 'path', None)
+        if body_path is None:
+            yield from rechunk(mail.iter_chunks(), self._chunk_size)
+            return
+        for offset in range(0, mail.size, self._chunk_size):
+            yield FileRange(body_path, offset,
+                            min(self._chunk_size, mail.size - offset))
+
+    def _bdat(self, mail):
+        window = BDAT_WINDOW if self._capabilities.pipelining else 0
+        pending = 0
+        previous = None
+        with self._metrics.timed(DATA):
+            for chunk in self._iter_bdat_chunks(mail):
+                if previous is not None:
+                    self._send_bdat(previous)
+                    pending += 1
+                    while pending > window:
+                        self._handle_response_code(*self._recv())
+                        pending -= 1
+                previous = chunk
+            self._send_bdat(previous, last=True)
+
+        with self._metrics.timed(RESPONSE):
+            self._recv_final_replies(pending + 1)
+
+    def _send_envelope(self, mail, recipients):
+        self._mail_from(mail)
+        return {recipient: self._rcpt_to(recipient)
+                for recipient in recipients}
+
+    def _send_envelope_pipelined(self, mail, recipients, with_data=True):
+        commands = [self._get_mail_from(mail),
+                    *(f'RCPT TO:<{recipient}>' for recipient in recipients)]
+        if with_data:
+            commands.append('DATA')
+        self._send_msg_to_server('\r\n'.join(commands), handle_resp=False)
+
+        with self._metrics.timed(MAIL_FROM):
+            responses = [self._recv()]
+        for _ in recipients:
+            with self._metrics.timed(RCPT):
+                responses.append(self._recv())
+        if with_data:
+            responses.append(self._recv())
+        self._handle_response_code(*responses[0])
+        data_resp = responses[-1] if with_data else None
+        return dict(zip(recipients, responses[1:])), data_resp
+
+    def _get_refused(self, responses):
+        refused = get_refused(responses)
+        for recipient, (code, resp) in refused.items():
+            if code != TOO_MANY_RECIPIENTS:
+                logging.warning(
+                    f'Recipient {recipient} refused: {code} {resp}')
+        return refused
+
+    def _rset(self):
+        self._send_msg_to_server('RSET')
+
+    def noop(self):
+        try:
+            self._send_msg_to_server('NOOP')
+        except SMTPException:
+            return False
+        return True
 
     def close(self):
         self._send_msg_to_server('QUIT', handle_resp=False)
         self._socket.close()
 
-    def send_mail(self, mail, bcc=None):
-        self._mail_from()
-        recipients = mail.recipients
+    def _send_transaction(self, mail, recipients):
+        if self._transactions > 0:
+            self._rset()
+        use_bdat = self._capabilities.chunking
+        if self._capabilities.pipelining:
+            responses, data_resp = self._send_envelope_pipelined(
+                mail, recipients, with_data=not use_bdat)
+        else:
+            responses = self._send_envelope(mail, recipients)
+            data_resp = None
+        refused = self._get_refused(responses)
+        if len(refused) == len(recipients):
+            self._rset()
+            return refused
+
+        if use_bdat:
+            self._bdat(mail)
+        else:
+            if data_resp is None:
+                data_resp = self._send_msg_to_server('DATA')
+            self._handle_response_code(*data_resp)
+            self._send_body(mail)
+        self._transactions += 1
+        return refused
+
+    def send_mail(self, mail, bcc=None, exclude=()):
+        check_mail_size(mail, self.max_size)
+        recipients = RecipientSet(mail.recipients)
         if bcc is not None:
-            Mail.validate_emails(bcc)
-            recipients.extend(bcc)
-
-        for recipient in recipients:
-            self._rcpt_to(recipient)
-        self._data(str(mail))
+            recipients.update(bcc)
+        recipients.difference_update(exclude)
+        if not recipients:
+            return {}
+
+        delivered = []
+        refused = {}
+        batches = deque(recipients.split(self.max_recipients))
+        try:
+            while batches:
+                batch = batches.popleft()
+                batch_refused = self._send_transaction(mail, batch)
+                refused.update(get_rejected(batch_refused))
+                accepted, deferred = get_batch_result(batch, batch_refused)
+                delivered.extend(accepted)
+                if deferred:
+                    logging.info('Deferring %d recipients to next '
+                                 'transaction', len(deferred))
+                    batches.appendleft(deferred)
+            if not delivered:
+                raise SMTPRecipientsRefusedException(refused)
+        except SMTPException as e:
+            e.delivered = delivered
+            e.refused = refused
+            raise
+        return refused
 
     def __enter__(self):
         return self
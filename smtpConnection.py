@@ -1,23 +1,372 @@
-from smtp import SMTPClient, SMTPDisconnectedException
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from retry import OPEN, CircuitBreaker, RetryPolicy, RetryStats
+from smtp import CAPABILITIES, SMTP_SERVER, SMTP_STARTTLS_SERVER, \
+    SMTPClient, SMTPDeliveryUnknownException, SMTPDisconnectedException, \
+    SMTPException, SMTPPermanentException, SMTPRecipientsRefusedException, \
+    SMTPTemporaryException, check_mail_size
 import logging
+import threading
+import time
+
+ROUND_ROBIN = 'roundrobin'
+LEAST_OUTSTANDING = 'least'
+IDLE_CHECK_INTERVAL = 10
+
+
+def get_relays(server, default=SMTP_SERVER):
+    if server is None:
+        return [(default, 1)]
+    if isinstance(server[0], str):
+        return [(tuple(server), 1)]
+    return [((host, port), weight[0] if weight else 1)
+            for host, port, *weight in server]
+
+
+def merge_partial(exc, delivered, refused):
+    delivered.extend(exc.delivered)
+    refused.update(exc.refused)
+    exc.delivered = delivered
+    exc.refused = refused
+
+
+def log_failed_mail(mail, exc):
+    logging.error(f"Mail to {', '.join(mail.recipients)} failed: {exc}")
+
+
+class RelaySelector:
+    def __init__(self, relays, balance=ROUND_ROBIN, failure_threshold=None):
+        self._relays = relays
+        self._balance = balance
+        self._failure_threshold = failure_threshold
+        if failure_threshold is None:
+            self._failure_threshold = 1 if len(relays) > 1 else 5
+        self._breakers = {}
+        self._outstanding = {server: 0 for server, _ in relays}
+        self._current_weights = {server: 0 for server, _ in relays}
+        self._lock = threading.Lock()
+
+    @property
+    def servers(self):
+        return [server for server, _ in self._relays]
+
+    def get_outstanding(self, server):
+        with self._lock:
+            return self._outstanding[server]
+
+    def _get_breaker(self, server):
+        with self._lock:
+            if server not in self._breakers:
+                self._breakers[server] = CircuitBreaker(
+                    failure_threshold=self._failure_threshold)
+            return self._breakers[server]
+
+    def is_healthy(self, server):
+        return self._get_breaker(server).state != OPEN
+
+    def choose(self, tried=()):
+        while True:
+            server = self._pick(tried)
+            if server is None or self._get_breaker(server).allow():
+                return server
+
+    def _pick(self, tried):
+        healthy = [(server, weight) for server, weight in self._relays
+                   if self.is_healthy(server)]
+        candidates = [e for e in healthy if e[0] not in tried] or healthy
+        if not candidates:
+            return
+
+        with self._lock:
+            if self._balance == LEAST_OUTSTANDING:
+                return min(candidates,
+                           key=lambda e: self._outstanding[e[0]] / e[1])[0]
+
+            total = sum(weight for _, weight in candidates)
+            for server, weight in candidates:
+                self._current_weights[server] += weight
+            server = max(candidates,
+                         key=lambda e: self._current_weights[e[0]])[0]
+            self._current_weights[server] -= total
+            return server
+
+    def record_failure(self, server):
+        self._get_breaker(server).record_failure()
+
+    def record_connected(self, server):
+        self._get_breaker(server).record_success()
+        with self._lock:
+            self._outstanding[server] += 1
+
+    def record_closed(self, server):
+        with self._lock:
+            self._outstanding[server] -= 1
 
 
 class SMTPConnection:
     def __init__(self, reconnection_count, login, passwd, server,
-                 disble_ssl):
-        self._reconnection_count = reconnection_count
+                 disble_ssl, pool_size=1, max_messages=None, max_age=None,
+                 retry_policy=None, balance=ROUND_ROBIN,
+                 failure_threshold=None, metrics=None, starttls=False,
+                 tls_sessions=None, capabilities_cache=None,
+                 verify_tls=True, idle_check=IDLE_CHECK_INTERVAL):
+        self._retry_policy = retry_policy
+        if retry_policy is None:
+            self._retry_policy = RetryPolicy(
+                connect_attempts=reconnection_count)
+        self._stats = RetryStats()
+        self._capabilities = CAPABILITIES if capabilities_cache is None \
+            else capabilities_cache
+        self._relays = RelaySelector(
+            get_relays(server,
+                       SMTP_STARTTLS_SERVER if starttls else SMTP_SERVER),
+            balance=balance, failure_threshold=failure_threshold)
         self._smtp_client_kwargs = {'login': login,
                                     'passwd': passwd,
-                                    'server': server,
-                                    'disable_ssl': disble_ssl}
+                                    'disable_ssl': disble_ssl,
+                                    'metrics': metrics,
+                                    'starttls': starttls,
+                                    'tls_sessions': tls_sessions,
+                                    'verify_tls': verify_tls,
+                                    'capabilities_cache': self._capabilities}
+        self._pool_size = pool_size
+        self._max_messages = max_messages
+        self._max_age = max_age
+        self._idle_check = idle_check
+        self._idle = []
+        self._size = 0
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    @property
+    def pool_size(self):
+        return self._pool_size
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def retry_policy(self):
+        return self._retry_policy
+
+    @property
+    def servers(self):
+        return self._relays.servers
+
+    def get_outstanding(self, server):
+        return self._relays.get_outstanding(server)
+
+    def is_healthy(self, server):
+        return self._relays.is_healthy(server)
 
     def create_connection(self):
         logging.info("Connecting to server")
-        while self._reconnection_count > 0:
+        tried = set()
+        attempts = self._retry_policy.connect_attempts
+        for attempt in range(attempts):
+            server = self._relays.choose(tried)
+            if server is None:
+                logging.info("All servers are marked unavailable")
+                return
+            if attempt > 0:
+                self._stats.increment('connect_retries')
+                self._retry_policy.wait(attempt - 1)
+
+            start = time.monotonic()
             try:
-                return SMTPClient(**self._smtp_client_kwargs)
+                client = SMTPClient(server=server,
+                                    **self._smtp_client_kwargs)
             except SMTPDisconnectedException:
+                self._relays.record_failure(server)
+                self._stats.increment('connect_failures')
+                tried.add(server)
                 logging.info(
-                    f"Try reconnecting to server ({self._reconnection_count}"
-                    " attempts left)")
-                self._reconnection_count -= 1
+                    f"Try reconnecting to server {server[0]}:{server[1]} "
+                    f"({attempts - attempt - 1} attempts left)")
+                continue
+            except BaseException:
+                self._relays.record_failure(server)
+                raise
+
+            self._relays.record_connected(server)
+            self._stats.record_latency('connect', time.monotonic() - start)
+            return client
+
+    def _is_expired(self, client):
+        if self._max_messages is not None and \
+                client.messages_sent >= self._max_messages:
+            return True
+        return self._max_age is not None and client.age >= self._max_age
+
+    def _close_client(self, client):
+        self._relays.record_closed(client.server)
+        try:
+            client.close()
+        except (SMTPException, OSError):
+            pass
+
+    def _free_slot(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def acquire(self, timeout=None):
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self._idle or self._size < self._pool_size,
+                    timeout):
+                raise SMTPDisconnectedException('No free connection in pool')
+            if self._idle:
+                client, released_at = self._idle.pop()
+            else:
+                client = None
+                self._size += 1
+
+        if client is not None:
+            if not self._is_expired(client) and (
+                    time.monotonic() - released_at < self._idle_check
+                    or client.noop()):
+                return client
+            self._close_client(client)
+
+        try:
+            client = self.create_connection()
+        except BaseException:
+            self._free_slot()
+            raise
+        if client is None:
+            self._free_slot()
+            raise SMTPDisconnectedException('Server is not available')
+        return client
+
+    def release(self, client, discard=False):
+        if discard or self._is_expired(client):
+            self._close_client(client)
+            self._free_slot()
+            return
+        with self._condition:
+            self._idle.append((client, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def session(self, timeout=None):
+        client = self.acquire(timeout=timeout)
+        try:
+            yield client
+        except BaseException:
+            self.release(client, discard=True)
+            raise
+        self.release(client)
+
+    def _get_cached_max_sizes(self):
+        capabilities = [self._capabilities.get(server)
+                        for server in self.servers]
+        if any(e is None for e in capabilities):
+            return
+        return [e.max_size for e in capabilities]
+
+    def get_max_size(self):
+        max_sizes = self._get_cached_max_sizes()
+        if max_sizes is not None:
+            return min((e for e in max_sizes if e is not None), default=None)
+        with self.session() as smtp:
+            return smtp.max_size
+
+    def _should_retry(self, attempts, kind, budget, exc):
+        attempts[kind] += 1
+        self._stats.increment(f'{kind}_failures')
+        if attempts[kind] >= budget:
+            return False
+
+        self._stats.increment(f'{kind}_retries')
+        delay = self._retry_policy.wait(attempts[kind] - 1)
+        logging.info(f'Retrying mail in {delay:.2f}s: {exc}')
+        return True
+
+    def send_mail(self, mail, bcc=None):
+        max_sizes = self._get_cached_max_sizes()
+        if max_sizes and None not in max_sizes:
+            check_mail_size(mail, max(max_sizes))
+        attempts = {'connect': 0, 'transient': 0}
+        delivered = []
+        refused = {}
+        while True:
+            try:
+                smtp = self.acquire()
+            except SMTPTemporaryException as e:
+                if not self._should_retry(
+                        attempts, 'transient',
+                        self._retry_policy.transient_attempts, e):
+                    raise
+                continue
+            start = time.monotonic()
+            try:
+                refused.update(smtp.send_mail(
+                    mail, bcc=bcc, exclude=[*delivered, *refused]))
+            except SMTPDeliveryUnknownException as e:
+                self.release(smtp, discard=True)
+                merge_partial(e, delivered, refused)
+                raise
+            except SMTPDisconnectedException as e:
+                self.release(smtp, discard=True)
+                merge_partial(e, delivered, refused)
+                if not self._should_retry(
+                        attempts, 'connect',
+                        self._retry_policy.connect_attempts, e):
+                    raise
+            except SMTPTemporaryException as e:
+                self.release(smtp, discard=True)
+                merge_partial(e, delivered, refused)
+                if not self._should_retry(
+                        attempts, 'transient',
+                        self._retry_policy.transient_attempts, e):
+                    raise
+            except SMTPRecipientsRefusedException as e:
+                self.release(smtp)
+                merge_partial(e, delivered, refused)
+                if not delivered:
+                    raise
+                return refused
+            except BaseException:
+                self.release(smtp, discard=True)
+                raise
+            else:
+                self.release(smtp)
+                self._stats.record_latency('send',
+                                           time.monotonic() - start)
+                return refused
+
+    def _send_or_skip(self, mail, bcc):
+        try:
+            return self.send_mail(mail, bcc)
+        except SMTPPermanentException as e:
+            log_failed_mail(mail, e)
+            return e
+
+    def send_mails(self, mails, bcc=None, skip_failed=False):
+        send = self._send_or_skip if skip_failed else self.send_mail
+        results = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self._pool_size) as executor:
+            for mail in mails:
+                if len(pending) >= self._pool_size:
+                    results.append(pending.popleft().result())
+                pending.append(executor.submit(send, mail, bcc))
+            results.extend(future.result() for future in pending)
+        return results
+
+    def close(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for client, _ in idle:
+            self._close_client(client)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from mail import AttachmentException, EmailValidationException, build_emails
+from smtp import SMTPDisconnectedException, SMTPException
+
+SUBMIT_TIMEOUT = 300
+SOCKET_MODE = 0o600
+VALIDATION_ERROR = 'validation'
+DELIVERY_ERROR = 'delivery'
+UNAVAILABLE_ERROR = 'unavailable'
+NOT_FOUND_ERROR = 'not_found'
+
+
+class DaemonException(Exception):
+    pass
+
+
+def get_error_type(exc):
+    if isinstance(exc, SMTPDisconnectedException):
+        return UNAVAILABLE_ERROR
+    if isinstance(exc, SMTPException):
+        return DELIVERY_ERROR
+    if isinstance(exc, OSError):
+        return NOT_FOUND_ERROR
+    return VALIDATION_ERROR
+
+
+def build_request(recipients, subject='', message='', attachments=None,
+                  bcc=None, sender=None, enable_html=False,
+                  max_attach_size=None):
+    request = {'recipients': list(recipients),
+               'subject': subject,
+               'message': message,
+               'html': enable_html}
+    if attachments:
+        request['attachments'] = [os.path.abspath(e) for e in attachments]
+    if bcc:
+        request['bcc'] = list(bcc)
+    if sender is not None:
+        request['sender'] = sender
+    if max_attach_size is not None:
+        request['max_attach_size'] = max_attach_size
+    return request
+
+
+def submit(socket_path, request, timeout=SUBMIT_TIMEOUT):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as file:
+            file.write(json.dumps(request).encode() + b'\n')
+            file.flush()
+            line = file.readline()
+    if not line:
+        raise DaemonException('Daemon closed connection without reply')
+    return json.loads(line)
+
+
+class SubmissionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.daemon.process(line)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class SubmissionServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, daemon, socket_path):
+        self.daemon = daemon
+        super().__init__(socket_path, SubmissionHandler)
+
+
+class MailDaemon:
+    def __init__(self, connection, socket_path, sender, bcc=None):
+        self._connection = connection
+        self._socket_path = socket_path
+        self._sender = sender
+        self._bcc = bcc
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._failed = 0
+
+    @property
+    def socket_path(self):
+        return self._socket_path
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'submitted': self._submitted, 'failed': self._failed}
+
+    def warm_up(self):
+        clients = [self._connection.acquire()
+                   for _ in range(getattr(self._connection, 'pool_size', 1))]
+        for client in clients:
+            self._connection.release(client)
+
+    def _send(self, request, progress):
+        mails = build_emails(request.get('sender', self._sender),
+                             request['recipients'],
+                             request.get('subject', ''),
+                             request.get('message', ''),
+                             enable_html=request.get('html', False),
+                             attachments=request.get('attachments'),
+                             max_attach_size=request.get('max_attach_size'))
+        progress['mails'] = len(mails)
+        bcc = request.get('bcc', self._bcc)
+        refused = {}
+        for mail in mails:
+            refused.update(self._connection.send_mail(mail, bcc=bcc))
+            progress['sent'] += 1
+        return {'status': 'ok', 'mails': len(mails), 'refused': refused}
+
+    def process(self, line):
+        progress = {'mails': 0, 'sent': 0}
+        try:
+            response = self._send(json.loads(line), progress)
+        except (ValueError, KeyError, TypeError, OSError,
+                AttachmentException, EmailValidationException,
+                SMTPException) as e:
+            logging.warning(f'Submission failed: {e}')
+            with self._lock:
+                self._failed += 1
+            return {'status': 'error',
+                    'error': str(e),
+                    'error_type': get_error_type(e),
+                    'sent': progress['sent'],
+                    'failed': progress['mails'] - progress['sent']}
+        with self._lock:
+            self._submitted += 1
+        return response
+
+    def _remove_socket(self):
+        try:
+            os.remove(self._socket_path)
+        except FileNotFoundError:
+            pass
+
+    def start(self):
+        self._remove_socket()
+        umask = os.umask(0o777 & ~SOCKET_MODE)
+        try:
+            self._server = SubmissionServer(self, self._socket_path)
+        finally:
+            os.umask(umask)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._remove_socket()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self._thread.join()
+        finally:
+            self.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,318 @@
+import logging
+import shutil
+import socket
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from os import path
+
+SINK_HOSTNAME = 'localhost'
+MAX_LINE_SIZE = 64 * 1024
+CERT_DAYS = 1
+
+
+class SinkException(Exception):
+    pass
+
+
+def generate_certificate(directory):
+    if shutil.which('openssl') is None:
+        raise SinkException('openssl is required to generate a certificate')
+    certfile = path.join(directory, 'sink.pem')
+    keyfile = path.join(directory, 'sink.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                    '-nodes', '-keyout', keyfile, '-out', certfile,
+                    '-days', str(CERT_DAYS), '-subj', f'/CN={SINK_HOSTNAME}'],
+                   check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+class SinkStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sessions = 0
+        self.messages = 0
+        self.recipients = 0
+        self.bytes_received = 0
+        self.commands = {}
+
+    def add_command(self, command):
+        with self._lock:
+            self.commands[command] = self.commands.get(command, 0) + 1
+
+    def add_message(self, recipients, size):
+        with self._lock:
+            self.messages += 1
+            self.recipients += recipients
+            self.bytes_received += size
+
+    def add_session(self):
+        with self._lock:
+            self.sessions += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {'sessions': self.sessions,
+                    'messages': self.messages,
+                    'recipients': self.recipients,
+                    'bytes_received': self.bytes_received,
+                    'commands': dict(self.commands)}
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.server.sink.tls:
+            self.request = self.server.sink.ssl_context.wrap_socket(
+                self.request, server_side=True)
+            self.connection = self.request
+        super().setup()
+
+    def _reply(self, code, *lines):
+        latency = self.server.sink.latency
+        if latency:
+            time.sleep(latency)
+        lines = lines or ('ok',)
+        response = ''.join(f'{code}-{line}\r\n' for line in lines[:-1])
+        response += f'{code} {lines[-1]}\r\n'
+        self.request.sendall(response.encode())
+
+    def _readline(self):
+        line = self.rfile.readline(MAX_LINE_SIZE)
+        if not line:
+            raise EOFError
+        return line
+
+    def _reset(self):
+        self._sender = None
+        self._recipients = []
+        self._body = []
+        self._body_size = 0
+
+    def _deliver(self):
+        self.server.sink.deliver(self._sender, self._recipients,
+                                 b''.join(self._body), self._body_size)
+        self._reset()
+
+    def _data(self):
+        if not self._recipients:
+            return self._reply(554, 'no valid recipients')
+        self._reply(354, 'go ahead')
+        while True:
+            line = self._readline()
+            if line.rstrip(b'\r\n') == b'.':
+                break
+            if line.startswith(b'..'):
+                line = line[1:]
+            self._body_size += len(line)
+            if self.server.sink.keep_messages:
+                self._body.append(line)
+        self._deliver()
+        if self.server.sink.drop_reply():
+            raise EOFError('reply dropped')
+        self._reply(250, 'queued')
+
+    def _bdat(self, params):
+        size, *last = params.split()
+        data = self.rfile.read(int(size))
+        self._body_size += len(data)
+        if self.server.sink.keep_messages:
+            self._body.append(data)
+        if last:
+            self._deliver()
+            if self.server.sink.drop_reply():
+                raise EOFError('reply dropped')
+        self._reply(250, f'{len(data)} bytes received')
+
+    def _mail_from(self, params):
+        sink = self.server.sink
+        size = 0
+        for param in params.split()[1:]:
+            key, _, value = param.partition('=')
+            if key.upper() == 'SIZE':
+                size = int(value)
+        if sink.max_size is not None and size > sink.max_size:
+            return self._reply(552, 'message size exceeds limit')
+        if params.split()[0].strip('<>') in sink.refused:
+            return self._reply(550, 'sender rejected')
+        self._sender = params.split()[0]
+        self._reply(250, 'sender ok')
+
+    def _rcpt_to(self, params):
+        address = params.strip().strip('<>')
+        sink = self.server.sink
+        if address in sink.refused:
+            return self._reply(550, 'no such user')
+        if sink.max_recipients is not None and \
+                len(self._recipients) >= sink.max_recipients:
+            return self._reply(452, 'too many recipients')
+        if sink.session_recipients is not None and \
+                self._session_recipients >= sink.session_recipients:
+            return self._reply(452, 'too many recipients this session')
+        self._session_recipients += 1
+        self._recipients.append(address)
+        self._reply(250, 'recipient ok')
+
+    def _ehlo(self):
+        sink = self.server.sink
+        extensions = [SINK_HOSTNAME, 'AUTH LOGIN PLAIN']
+        if sink.pipelining:
+            extensions.append('PIPELINING')
+        if sink.chunking:
+            extensions.append('CHUNKING')
+        if sink.max_size is not None:
+            extensions.append(f'SIZE {sink.max_size}')
+        if sink.starttls and not isinstance(self.request, ssl.SSLSocket):
+            extensions.append('STARTTLS')
+        self._reply(250, *extensions)
+
+    def _start_tls(self):
+        self._reply(220, 'ready to start TLS')
+        self.request = self.server.sink.ssl_context.wrap_socket(
+            self.request, server_side=True)
+        self.connection = self.request
+        self.rfile = self.request.makefile('rb', self.rbufsize)
+        self._reset()
+
+    def _auth(self, params):
+        mechanism, _, initial_response = params.partition(' ')
+        if mechanism.upper() == 'PLAIN' and initial_response:
+            return self._reply(235, 'authenticated')
+        self._reply(334, 'VXNlcm5hbWU6')
+        self._readline()
+        self._reply(334, 'UGFzc3dvcmQ6')
+        self._readline()
+        self._reply(235, 'authenticated')
+
+    def handle(self):
+        self.server.sink.stats.add_session()
+        self._session_recipients = 0
+        self._reset()
+        try:
+            self._reply(220, f'{SINK_HOSTNAME} sink ready')
+            while True:
+                line = self._readline().decode(errors='replace').strip()
+                command, _, params = line.partition(' ')
+                command = command.upper()
+                if command:
+                    self.server.sink.stats.add_command(command)
+                if command in ('EHLO', 'HELO'):
+                    self._ehlo()
+                elif command == 'STARTTLS' and self.server.sink.starttls:
+                    self._start_tls()
+                elif command == 'AUTH':
+                    self._auth(params)
+                elif command == 'MAIL':
+                    self._mail_from(params.partition(':')[2])
+                elif command == 'RCPT':
+                    self._rcpt_to(params.partition(':')[2])
+                elif command == 'DATA':
+                    self._data()
+                elif command == 'BDAT':
+                    self._bdat(params)
+                elif command == 'RSET':
+                    self._reset()
+                    self._reply(250, 'reset')
+                elif command == 'NOOP':
+                    self._reply(250, 'ok')
+                elif command == 'QUIT':
+                    self._reply(221, 'bye')
+                    return
+                elif not command:
+                    continue
+                else:
+                    self._reply(500, 'unknown command')
+        except (EOFError, OSError) as e:
+            logging.debug(f'Sink session closed: {e}')
+
+
+class SinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, sink, address):
+        self.sink = sink
+        super().__init__(address, SinkHandler)
+
+
+class SMTPSink:
+    def __init__(self, host='127.0.0.1', port=0, tls=False, latency=0,
+                 max_size=None, pipelining=True, chunking=True,
+                 refused=None, keep_messages=True, certfile=None,
+                 keyfile=None, starttls=False, max_recipients=None,
+                 session_recipients=None, drop_replies=0):
+        self._address = (host, port)
+        self.tls = tls
+        self.starttls = starttls
+        self._certfile = certfile
+        self._keyfile = keyfile
+        self._cert_dir = None
+        self.latency = latency
+        self.max_size = max_size
+        self.pipelining = pipelining
+        self.chunking = chunking
+        self.refused = set(refused or ())
+        self.max_recipients = max_recipients
+        self.session_recipients = session_recipients
+        self.drop_replies = drop_replies
+        self.keep_messages = keep_messages
+        self.ssl_context = None
+        self.stats = SinkStats()
+        self.messages = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def server(self):
+        return self._server.server_address[:2]
+
+    def _create_ssl_context(self):
+        if self._certfile is None:
+            self._cert_dir = tempfile.mkdtemp(prefix='smtp-sink-')
+            self._certfile, self._keyfile = generate_certificate(
+                self._cert_dir)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self._certfile, self._keyfile)
+        return context
+
+    def deliver(self, sender, recipients, body, size):
+        self.stats.add_message(len(recipients), size)
+        if self.keep_messages:
+            with self._lock:
+                self.messages.append((sender, recipients, body))
+
+    def drop_reply(self):
+        with self._lock:
+            if self.drop_replies <= 0:
+                return False
+            self.drop_replies -= 1
+            return True
+
+    def start(self):
+        if self.tls or self.starttls:
+            self.ssl_context = self._create_ssl_context()
+        self._server = SinkServer(self, self._address)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if self._cert_dir is not None:
+            shutil.rmtree(self._cert_dir, ignore_errors=True)
+            self._cert_dir = None
+            self._certfile = self._keyfile = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -4,17 +4,39 @@ if sys.version_info[:2] < (3, 6):
     print('This code need Python 3.6 or higher')
     sys.exit(10)
 
+import asyncio
 import base64
+import email
+import json
+import os
+import shutil
 import tempfile
 import textwrap
 import unittest
-from ssl import SSLSocket
+from concurrent.futures import ThreadPoolExecutor
+from ssl import SSLError, SSLSocket
 from unittest.mock import patch
 import re
 from os import path
 from mail import Mail, EmailValidationException, build_emails, \
-    get_attachments_content
-from smtp import SMTPClient, SMTPPermanentException
+    get_attachments_content, FileAttachment, PartCache, pack_attachments, \
+    iter_emails
+from smtp import SMTPClient, SMTPPermanentException, \
+    SMTPDisconnectedException, SMTPTemporaryException, TLSSessionCache, \
+    SMTPDeliveryUnknownException, CAPABILITIES, CapabilityCache, \
+    ResponseReader, SMTPCapabilities, create_ssl_context, dot_stuff, \
+    get_response_exception, parse_response
+from asyncSmtp import AsyncSMTPClient
+from smtpConnection import SMTPConnection
+from asyncSmtpConnection import AsyncSMTPConnection
+from bulk import BulkException, build_bulk_emails, read_recipients
+from spool import Spool, SpoolWorker
+from retry import CircuitBreaker, RetryPolicy
+from metrics import MetricsAggregator
+from main import start_pipeline
+from smtpSink import SMTPSink
+from recipients import RecipientSet
+from smtpDaemon import MailDaemon, build_request, submit
 
 test_mail = 'test@gmail.com'
 test_pwd = 'pwd'
@@ -26,24 +48,167 @@ DEFAULT_RESPONSES = {b'EHLO owrld\r\n': b'250 ok',
                      b'QUIT\r\n': b'221 closing'}
 
 
-class MockSocketFile:
-    def readline(self, *args, **kw):
-        return Tests.mock_recv(None, None)
+class MockStreamWriter:
+    def __init__(self):
+        self.data = []
+        self.transport = self
+        self.closed = False
+
+    def write(self, data):
+        self.data.append(bytes(data))
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return self.closed
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def close(self):
+        self.closed = True
+
+
+class MockPoolClient:
+    created = []
+
+    def __init__(self, server=None, **kw):
+        self.server = server
+        self.messages_sent = 0
+        self.age = 0
+        self.closed = False
+        MockPoolClient.created.append(self)
+
+    def noop(self):
+        return not self.closed
+
+    def send_mail(self, mail, bcc=None, exclude=()):
+        self.messages_sent += 1
+        return {}
+
+    def close(self):
+        self.closed = True
+
+
+class MockAsyncDisconnectingClient:
+    created = 0
+
+    def __init__(self, server=None, **kw):
+        MockAsyncDisconnectingClient.created += 1
+        self.server = server
+
+    async def connect(self):
+        return self
+
+    async def send_mail(self, mail, bcc=None, exclude=()):
+        raise SMTPDisconnectedException('connection lost')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class MockAsyncTemporaryClient(MockAsyncDisconnectingClient):
+    sent = []
+
+    async def send_mail(self, mail, bcc=None, exclude=()):
+        if MockAsyncDisconnectingClient.created == 1:
+            raise SMTPTemporaryException('451 try again later')
+        MockAsyncTemporaryClient.sent.append(mail)
+        return {}
+
+
+class MockAsyncRelayClient(MockAsyncDisconnectingClient):
+    down = set()
+    connects = []
+
+    async def connect(self):
+        MockAsyncRelayClient.connects.append(self.server)
+        if self.server in MockAsyncRelayClient.down:
+            raise SMTPDisconnectedException('Server is not available')
+        return self
+
+    async def send_mail(self, mail, bcc=None, exclude=()):
+        await asyncio.sleep(0)
+        return {}
+
+
+class MockAsyncFailingClient(MockAsyncDisconnectingClient):
+    closed = 0
+
+    async def send_mail(self, mail, bcc=None, exclude=()):
+        if mail == 0:
+            raise SMTPPermanentException('550 rejected')
+        await asyncio.sleep(1)
+        return {}
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.sleep(0.01)
+        MockAsyncFailingClient.closed += 1
+
+
+class MockSpoolConnection:
+    def __init__(self, errors):
+        self.errors = errors
+        self.sent = []
+
+    def send_mail(self, mail, bcc=None, exclude=()):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(b''.join(mail.iter_chunks()))
+        return {}
+
+
+class MockRetryClient:
+    connect_failures = []
+    send_failures = []
+
+    def __init__(self, server=None, **kw):
+        self.server = server
+        self.messages_sent = 0
+        self.age = 0
+        if MockRetryClient.connect_failures:
+            raise MockRetryClient.connect_failures.pop(0)
+
+    def send_mail(self, mail, bcc=None, exclude=()):
+        if MockRetryClient.send_failures:
+            raise MockRetryClient.send_failures.pop(0)
+        self.messages_sent += 1
+        return {}
+
+    def close(self):
+        pass
+
+
+class MockRelayClient(MockPoolClient):
+    down = set()
+
+    def __init__(self, server=None, **kw):
+        if server in MockRelayClient.down:
+            raise SMTPDisconnectedException('down')
+        super().__init__(server=server, **kw)
 
 
 @patch.object(SSLSocket, 'connect', lambda *args, **kw: None)
+@patch.object(SSLSocket, 'do_handshake', lambda *args, **kw: None)
 @patch.object(SSLSocket, 'sendall', lambda *args: Tests.mock_send(*args))
-@patch.object(SSLSocket, 'recv', lambda *args: Tests.mock_recv(*args))
-@patch.object(SSLSocket, 'makefile', lambda e, *args: MockSocketFile())
+@patch.object(SSLSocket, 'recv_into',
+              lambda sock, buffer, *args: Tests.mock_recv_into(buffer))
 class Tests(unittest.TestCase):
     responses = {}
     requests = []
     current_requests = []
+    pending_responses = []
 
     def setUp(self):
-        Tests.responses = DEFAULT_RESPONSES
+        Tests.responses = dict(DEFAULT_RESPONSES)
         Tests.current_requests = []
         Tests.requests = []
+        Tests.pending_responses = []
+        CAPABILITIES.clear()
 
     @staticmethod
     def get_requests(additional_requests=None):
@@ -58,18 +223,34 @@ class Tests(unittest.TestCase):
 
     @staticmethod
     def mock_send(mock_obj, data):
+        data = bytes(data)
         Tests.requests.append(data)
         Tests.current_requests.append(data)
 
+    @staticmethod
+    def mock_recv_into(buffer):
+        data = Tests.mock_recv(None, None)
+        if not data.endswith(b'\n'):
+            data += b'\r\n'
+        buffer[:len(data)] = data
+        return len(data)
+
     @staticmethod
     def mock_recv(mock_obj, length):
+        if Tests.pending_responses:
+            return Tests.pending_responses.pop(0)
         if len(Tests.current_requests) == 0:
             return b'500 err'
         req = Tests.current_requests.pop()
 
-        if req in Tests.responses:
-            return Tests.responses[req]
-        return b'500 err'
+        resp = Tests.responses.get(req)
+        if resp is None:
+            resp = next((value for key, value in Tests.responses.items()
+                         if req.endswith(key)), b'500 err')
+        if isinstance(resp, list):
+            Tests.pending_responses = resp[1:]
+            return resp[0]
+        return resp
 
     def test_connected_to_server(self):
         with SMTPClient(test_mail, test_pwd):
@@ -100,7 +281,7 @@ class Tests(unittest.TestCase):
                             ['rec1@gmail.com', 'rec2@gmail.com'],
                             'subject', message=message,
                             attachments=get_attachments_content([file.name]))
-        mail = str(mail)
+                mail = str(mail)
         delimiter = BOUNDARY_RE.search(mail).group(1)
 
         message = base64.b64encode(message.encode()).decode()
@@ -133,6 +314,85 @@ class Tests(unittest.TestCase):
                                file_content, delimiter))
         self.assertEqual(valid_mail, mail)
 
+    def test_mail_chunks(self):
+        mail = Mail(test_mail, ['r@g.com'], 'subject', message='msg',
+                    attachments=[('file.txt', 'Y29udGVudA==')])
+        chunks = list(mail.iter_chunks())
+
+        self.assertTrue(all(isinstance(e, memoryview) for e in chunks))
+        self.assertEqual(b''.join(chunks).decode(), str(mail))
+
+    def test_mail_headers(self):
+        mails = [Mail(test_mail, ['r1@g.com', 'r2@g.com'], 'subj')
+                 for _ in range(2)]
+        boundaries = [BOUNDARY_RE.search(str(mail)).group(1)
+                      for mail in mails]
+
+        self.assertNotEqual(boundaries[0], boundaries[1])
+        self.assertTrue(str(mails[0]).startswith(
+            f'Content-Type: multipart/mixed; boundary="{boundaries[0]}"\n'
+            'MIME-Version: 1.0\nSubject: subj\nFrom: test@gmail.com\n'
+            'To: r1@g.com, r2@g.com\n'))
+        self.assertTrue(Mail.is_valid_email('r1@g.com'))
+        self.assertFalse(Mail.is_valid_email('r1@'))
+
+    def test_attachment_encoding(self):
+        content = bytes(range(256)) * 40
+
+        with tempfile.TemporaryDirectory() as dir:
+            filename = path.join(dir, 'tmpfile')
+            with open(filename, mode='wb') as file:
+                file.write(content)
+            attachment = FileAttachment(filename, block_size=100)
+            encoded = b''.join(attachment.iter_chunks())
+
+        self.assertEqual(encoded, base64.encodebytes(content))
+        self.assertEqual(len(encoded), attachment.encoded_size)
+        self.assertTrue(all(len(line) <= 76
+                            for line in encoded.splitlines()))
+
+    def test_part_cache(self):
+        cache = PartCache(max_parts=2)
+        with patch.object(Mail, 'part_cache', cache), \
+                tempfile.TemporaryDirectory() as dir:
+            filename = path.join(dir, 'tmpfile')
+            with open(filename, mode='w') as file:
+                file.write('content')
+            attachments = get_attachments_content([filename])
+
+            Mail(test_mail, ['r@g.com'], 'subj', message='msg',
+                 attachments=attachments)
+            self.assertEqual(len(cache), 2)
+            with open(filename, mode='w') as file:
+                file.write('new content')
+            os.utime(filename, ns=(0, 0))
+            attachments = get_attachments_content([filename])
+            mail = Mail(test_mail, ['r@g.com'], 'subj', message='msg',
+                        attachments=attachments)
+
+            self.assertEqual(len(cache), 2)
+            self.assertIn(base64.b64encode(b'new content').decode(),
+                          str(mail))
+            self.assertLessEqual(cache.size, len(str(mail)))
+
+            content = attachments[0][1]
+            self.assertFalse(content.preloaded)
+            size = cache.size
+            Mail(test_mail, ['r@g.com'], 'subj', attachments=attachments)
+            self.assertTrue(content.preloaded)
+            self.assertEqual(cache.size, size + content.encoded_size)
+
+    def test_pack_attachments(self):
+        items = [(5, 'a'), (4, 'b'), (3, 'c'), (3, 'd'), (3, 'e'), (2, 'f')]
+        sizes = dict((info, size) for size, info in items)
+        blocks = pack_attachments(items, 10)
+
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual(sorted(sum(blocks, [])), list('abcdef'))
+        self.assertTrue(all(sum(sizes[e] for e in block) <= 10
+                            for block in blocks))
+        self.assertEqual(blocks[0][0], 'a')
+
     def test_splits_mails(self):
         def get_suffix(curr_block, block_count):
             return '<p><i>{} of {} ' \
@@ -174,13 +434,87 @@ class Tests(unittest.TestCase):
                 valid_mails = [mail1, mail2]
                 self.assertListEqual(mails, valid_mails)
 
+    def test_build_emails_max_size_without_attachments(self):
+        mails = build_emails(test_mail, ['r@g.com'], 'subj', 'msg',
+                             max_attach_size=1)
+        self.assertEqual(len(mails), 1)
+        self.assertIn(base64.b64encode(b'msg').decode(), str(mails[0]))
+
+    def test_iter_emails(self):
+        def normalize(mail):
+            mail = str(mail)
+            return mail.replace(BOUNDARY_RE.search(mail).group(1), 'b')
+
+        with tempfile.TemporaryDirectory() as dir:
+            attachments = []
+            for i in range(4):
+                attachments.append(path.join(dir, 'file{}'.format(i)))
+                with open(attachments[-1], 'wb') as file:
+                    file.write(os.urandom(300 * 1024 * (i + 1)))
+
+            args = (test_mail, ['r@g.com'], 'subj', 'msg', attachments)
+            expected = [normalize(e)
+                        for e in build_emails(*args, max_attach_size=1)]
+            Mail.part_cache.clear()
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                mails = iter_emails(*args, max_attach_size=1,
+                                    executor=executor, prefetch=2)
+                first = next(mails)
+                self.assertTrue(all(content.preloaded
+                                    for content in first._parts
+                                    if isinstance(content, FileAttachment)))
+                actual = [normalize(e) for e in [first, *mails]]
+
+                Mail.part_cache.clear()
+                with patch('mail.PREFETCH_BLOCK_SIZE', 1024 ** 2):
+                    mail, = iter_emails(*args, executor=executor)
+                self.assertListEqual([content.preloaded
+                                      for content in mail._parts
+                                      if isinstance(content, FileAttachment)],
+                                     [True, False, False, False])
+
+                cache = PartCache(max_part_size=450 * 1024)
+                with patch.object(Mail, 'part_cache', cache), \
+                        patch.object(executor, 'submit',
+                                     wraps=executor.submit) as submit:
+                    for submitted in (4, 3):
+                        submit.reset_mock()
+                        str(next(iter_emails(*args, executor=executor)))
+                        self.assertEqual(submit.call_count, submitted)
+
+        self.assertGreater(len(expected), 1)
+        self.assertListEqual(actual, expected)
+
+    def test_recipient_set(self):
+        recipients = RecipientSet(['a@x.com', 'b@y.com', 'A@X.COM',
+                                   'c@x.com', 'a@x.com'])
+        self.assertListEqual(list(recipients), ['a@x.com', 'b@y.com',
+                                                'A@X.COM', 'c@x.com'])
+        self.assertIn('b@Y.com', recipients)
+        self.assertListEqual(recipients.split(2),
+                             [['a@x.com', 'A@X.COM'], ['c@x.com', 'b@y.com']])
+        self.assertListEqual(recipients.split(None), [list(recipients)])
+        self.assertRaises(EmailValidationException, recipients.add, 'bad')
+
+    def test_start_pipeline(self):
+        mails = start_pipeline(lambda: iter(range(10)), 2)
+        self.assertListEqual(list(mails), list(range(10)))
+
+        def build():
+            yield 1
+            sys.exit(1)
+
+        mails = start_pipeline(build, 1)
+        self.assertEqual(next(mails), 1)
+        self.assertRaises(SystemExit, next, mails)
+
     def test_send_mail(self):
         message = 'msg\nline2\n.\n'
         recipients = ['r1@gmail.com', 'r2@gmail.com']
 
         Tests.responses[
             'MAIL FROM:<{}>\r\n'.format(test_mail).encode()] = b'250 ok'
-        Tests.responses[b'.\r\n'] = b'250 ok'
+        Tests.responses[b'\r\n.\r\n'] = b'250 ok'
         Tests.responses[b'DATA\r\n'] = b'250 ok'
 
         valid_requests = ['MAIL FROM:<{}>\r\n'.format(test_mail).encode()]
@@ -193,13 +527,771 @@ class Tests(unittest.TestCase):
         with SMTPClient(test_mail, test_pwd) as smtp:
             smtp.send_mail(mail)
 
-        valid_requests.extend([
-            b'DATA\r\n',
-            str(mail).encode() + b'\r\n',
-            b'.\r\n'])
+        valid_requests.append(b'DATA\r\n')
+        valid_requests.append(
+            b''.join(mail.iter_chunks()) + b'\r\n.\r\n')
+
+        self.assertListEqual(self.requests, self.get_requests(valid_requests))
+
+    def test_reuses_session(self):
+        recipients = ['r1@gmail.com']
+        mail_from = 'MAIL FROM:<{}>\r\n'.format(test_mail).encode()
+        rcpt_to = b'RCPT TO:<r1@gmail.com>\r\n'
+        Tests.responses[mail_from] = b'250 ok'
+        Tests.responses[rcpt_to] = b'250 ok'
+        Tests.responses[b'DATA\r\n'] = b'354 go ahead'
+        Tests.responses[b'\r\n.\r\n'] = b'250 ok'
+        Tests.responses[b'RSET\r\n'] = b'250 ok'
+
+        mails = [Mail(test_mail, recipients, 'subject', message='msg')
+                 for _ in range(2)]
+        with SMTPClient(test_mail, test_pwd) as smtp:
+            for mail in mails:
+                smtp.send_mail(mail)
+
+        valid_requests = []
+        for i, mail in enumerate(mails):
+            if i > 0:
+                valid_requests.append(b'RSET\r\n')
+            valid_requests.extend([mail_from, rcpt_to, b'DATA\r\n'])
+            valid_requests.append(
+                b''.join(mail.iter_chunks()) + b'\r\n.\r\n')
+
+        self.assertListEqual(self.requests, self.get_requests(valid_requests))
+
+    def test_pipelining(self):
+        recipients = ['r1@gmail.com', 'r2@gmail.com']
+        Tests.responses[b'EHLO owrld\r\n'] = [b'250-smtp.test\r\n',
+                                              b'250-PIPELINING\r\n',
+                                              b'250 SIZE 1000\r\n']
+        mail = Mail(test_mail, recipients, 'subject', message='msg')
+        envelope = ('MAIL FROM:<{}> SIZE={}\r\nRCPT TO:<r1@gmail.com>\r\n'
+                    'RCPT TO:<r2@gmail.com>\r\nDATA\r\n').format(test_mail,
+                                                                 mail.size)
+        envelope = envelope.encode()
+        Tests.responses[envelope] = [b'250 ok\r\n',
+                                     b'550 no such user\r\n',
+                                     b'250 ok\r\n',
+                                     b'354 go ahead\r\n']
+        Tests.responses[b'\r\n.\r\n'] = b'250 ok'
+
+        with SMTPClient(test_mail, test_pwd) as smtp:
+            self.assertEqual(smtp.extensions, {'PIPELINING': '',
+                                               'SIZE': '1000'})
+            refused = smtp.send_mail(mail)
+            with self.assertRaises(SMTPPermanentException):
+                smtp.send_mail(Mail(test_mail, recipients, 'subject',
+                                    message='m' * 1000))
 
+        valid_requests = [envelope]
+        valid_requests.append(
+            b''.join(mail.iter_chunks()) + b'\r\n.\r\n')
+        self.assertEqual(refused, {'r1@gmail.com': (550, 'no such user')})
         self.assertListEqual(self.requests, self.get_requests(valid_requests))
 
+    def test_metrics(self):
+        recipients = ['r1@gmail.com', 'r2@gmail.com']
+        Tests.responses[
+            'MAIL FROM:<{}>\r\n'.format(test_mail).encode()] = b'250 ok'
+        for recipient in recipients:
+            Tests.responses[
+                'RCPT TO:<{}>\r\n'.format(recipient).encode()] = b'250 ok'
+        Tests.responses[b'DATA\r\n'] = b'354 go ahead'
+        Tests.responses[b'\r\n.\r\n'] = b'250 ok'
+
+        metrics = MetricsAggregator()
+        mail = Mail(test_mail, recipients, 'subject', message='msg')
+        with SMTPClient(test_mail, test_pwd, metrics=metrics) as smtp:
+            smtp.send_mail(mail)
+
+        phases = metrics.as_dict()['phases']
+        self.assertEqual(list(phases), ['connect', 'tls', 'greeting', 'ehlo',
+                                        'auth', 'mail_from', 'rcpt', 'data',
+                                        'response'])
+        self.assertEqual(phases['rcpt']['count'], 2)
+        self.assertEqual(metrics.codes, {250: 5, 334: 2, 335: 1, 354: 1})
+        self.assertEqual(metrics.bytes_sent,
+                         sum(len(request) for request in self.requests))
+        self.assertIn('rcpt', metrics.dump(histograms=True))
+
+    def test_capabilities(self):
+        Tests.responses[b'EHLO owrld\r\n'] = [b'250-smtp.test\r\n',
+                                              b'250-PIPELINING\r\n',
+                                              b'250-CHUNKING\r\n',
+                                              b'250-8BITMIME\r\n',
+                                              b'250-AUTH LOGIN PLAIN\r\n',
+                                              b'250-AUTH=XOAUTH2\r\n',
+                                              b'250-LIMITS RCPTMAX=50\r\n',
+                                              b'250 SIZE 1000\r\n']
+        token = base64.b64encode(
+            '\0{}\0{}'.format(test_mail, test_pwd).encode())
+        auth = b'AUTH PLAIN ' + token + b'\r\n'
+        Tests.responses[auth] = b'235 ok'
+
+        cache = CapabilityCache()
+        with SMTPClient(test_mail, test_pwd, capabilities_cache=cache) as smtp:
+            capabilities = smtp.capabilities
+        self.assertIs(cache.get(smtp.server), capabilities)
+        self.assertTrue(capabilities.pipelining and capabilities.chunking)
+        self.assertTrue(capabilities.eightbitmime)
+        self.assertFalse(capabilities.smtputf8 or capabilities.starttls)
+        self.assertEqual(capabilities.max_size, 1000)
+        self.assertEqual(capabilities.max_recipients, 50)
+        self.assertEqual(smtp.max_recipients, 50)
+        self.assertEqual(capabilities.auth_mechanisms,
+                         {'LOGIN', 'PLAIN', 'XOAUTH2'})
+        self.assertListEqual(self.requests, [b'EHLO owrld\r\n', auth,
+                                             b'QUIT\r\n'])
+
+        cache.set(('relay', 25), SMTPCapabilities({'SIZE': '10'}))
+        conn = SMTPConnection(1, test_mail, test_pwd, [('relay', 25, 1)],
+                              False, capabilities_cache=cache)
+        self.assertEqual(conn.get_max_size(), 10)
+        with self.assertRaises(SMTPPermanentException):
+            conn.send_mail(Mail(test_mail, ['r1@gmail.com'], 'subject'))
+
+    @patch('asyncSmtpConnection.AsyncSMTPClient',
+           MockAsyncDisconnectingClient)
+    def test_async_reconnect_limit(self):
+        MockAsyncDisconnectingClient.created = 0
+        conn = AsyncSMTPConnection(3, test_mail, test_pwd, None, False,
+                                   retry_policy=RetryPolicy(base_delay=0))
+        loop = asyncio.new_event_loop()
+        with self.assertRaises(SMTPDisconnectedException):
+            loop.run_until_complete(conn.send_mails([None]))
+        loop.close()
+        self.assertEqual(MockAsyncDisconnectingClient.created, 3)
+
+    @patch('asyncSmtpConnection.AsyncSMTPClient', MockAsyncTemporaryClient)
+    def test_async_retries_temporary_errors(self):
+        MockAsyncDisconnectingClient.created = 0
+        MockAsyncTemporaryClient.sent = []
+        conn = AsyncSMTPConnection(1, test_mail, test_pwd, None, False,
+                                   retry_policy=RetryPolicy(base_delay=0))
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(conn.send_mails(['mail']))
+        loop.close()
+        self.assertEqual(MockAsyncDisconnectingClient.created, 2)
+        self.assertEqual(MockAsyncTemporaryClient.sent, ['mail'])
+
+    @patch('asyncSmtpConnection.AsyncSMTPClient', MockAsyncRelayClient)
+    def test_async_multiple_servers(self):
+        relay1, relay2, relay3 = ('r1', 25), ('r2', 25), ('r3', 25)
+        MockAsyncRelayClient.down = {relay1}
+        MockAsyncRelayClient.connects = []
+        conn = AsyncSMTPConnection(2, test_mail, test_pwd,
+                                   [(*relay1, 1), (*relay2, 2),
+                                    (*relay3, 1)], False,
+                                   retry_policy=RetryPolicy(base_delay=0))
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(conn.send_mails(range(8), sessions=4))
+        loop.close()
+
+        self.assertEqual(MockAsyncRelayClient.connects.count(relay1), 1)
+        self.assertEqual(MockAsyncRelayClient.connects.count(relay2), 3)
+        self.assertEqual(MockAsyncRelayClient.connects.count(relay3), 1)
+
+    @patch('asyncSmtpConnection.AsyncSMTPClient', MockAsyncFailingClient)
+    def test_async_workers_finish_on_error(self):
+        MockAsyncFailingClient.closed = 0
+        conn = AsyncSMTPConnection(1, test_mail, test_pwd, None, False)
+        loop = asyncio.new_event_loop()
+        with self.assertRaises(SMTPPermanentException):
+            loop.run_until_complete(conn.send_mails(range(4), sessions=4))
+        self.assertEqual(asyncio.all_tasks(loop), set())
+        loop.close()
+        self.assertEqual(MockAsyncFailingClient.closed, 4)
+
+    def test_async_sender_refused(self):
+        mail = Mail(test_mail, ['r1@gmail.com'], 'subject', message='msg')
+        loop = asyncio.new_event_loop()
+        with SMTPSink(refused={test_mail}) as sink:
+            conn = AsyncSMTPConnection(3, test_mail, test_pwd, sink.server,
+                                       True)
+            with self.assertRaises(SMTPPermanentException):
+                loop.run_until_complete(conn.send_mails([mail]))
+        loop.close()
+        self.assertEqual(sink.stats.as_dict()['sessions'], 1)
+
+    def test_async_send_mail(self):
+        recipients = ['r1@gmail.com', 'r2@gmail.com']
+        mail = Mail(test_mail, recipients, 'subject', message='msg')
+        writer = MockStreamWriter()
+
+        async def open_connection(*args, **kw):
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'220 hello\r\n'
+                             b'250-smtp.test\r\n250 PIPELINING\r\n'
+                             b'334 ok\r\n334 ok\r\n235 ok\r\n'
+                             b'250 ok\r\n250 ok\r\n250 ok\r\n354 go\r\n'
+                             b'250 ok\r\n')
+            return reader, writer
+
+        async def send():
+            async with await AsyncSMTPClient(test_mail,
+                                             test_pwd).connect() as smtp:
+                return await smtp.send_mail(mail)
+
+        loop = asyncio.new_event_loop()
+        with patch('asyncSmtp.asyncio.open_connection', open_connection):
+            refused = loop.run_until_complete(send())
+        loop.close()
+
+        envelope = 'MAIL FROM:<{}>\r\nRCPT TO:<r1@gmail.com>\r\n' \
+                   'RCPT TO:<r2@gmail.com>\r\nDATA'.format(test_mail)
+        sent = b''.join(writer.data)
+        valid_data = b''.join([*self.get_requests()[:-1],
+                               envelope.encode(), b'\r\n',
+                               *mail.iter_chunks(), b'\r\n.\r\n',
+                               b'QUIT\r\n'])
+        self.assertEqual(refused, {})
+        self.assertEqual(sent, valid_data)
+
+    @patch('smtpConnection.SMTPClient', MockPoolClient)
+    def test_connection_pool(self):
+        MockPoolClient.created = []
+        conn = SMTPConnection(1, test_mail, test_pwd, None, False,
+                              pool_size=2, max_messages=3)
+        with conn:
+            results = conn.send_mails(range(10))
+
+        sent = sum(e.messages_sent for e in MockPoolClient.created)
+        self.assertEqual(results, [{}] * 10)
+        self.assertEqual(sent, 10)
+        self.assertTrue(all(e.messages_sent <= 3
+                            for e in MockPoolClient.created))
+        self.assertTrue(all(e.closed for e in MockPoolClient.created))
+
+        with conn.session() as first:
+            with conn.session() as second:
+                self.assertIsNot(first, second)
+                with self.assertRaises(SMTPDisconnectedException):
+                    conn.acquire(timeout=0)
+
+    def test_bulk_emails(self):
+        with tempfile.TemporaryDirectory() as dir:
+            recipients = path.join(dir, 'recipients.csv')
+            attachment = path.join(dir, 'report.txt')
+            with open(recipients, mode='w') as file:
+                file.write('email,name\nr1@gmail.com,Bob\nr2@gmail.com,Ann\n')
+            with open(attachment, mode='w') as file:
+                file.write('report')
+
+            Mail.part_cache.clear()
+            mails = build_bulk_emails(test_mail, read_recipients(recipients),
+                                      'Hi $name', 'Dear $name',
+                                      attachments=[attachment])
+            self.assertNotIsInstance(mails, list)
+            mails = list(mails)
+            self.assertEqual(len(Mail.part_cache), 1)
+            with patch('bulk.PART_CACHE', PartCache(max_part_size=4)), \
+                    patch.object(FileAttachment, 'preload') as preload:
+                build_bulk_emails(test_mail, read_recipients(recipients),
+                                  'Hi $name', 'Dear $name',
+                                  attachments=[attachment])
+            os.remove(attachment)
+            mails = [(e.recipients, str(e)) for e in mails]
+
+        self.assertEqual([e[0] for e in mails],
+                         [['r1@gmail.com'], ['r2@gmail.com']])
+        for (_, mail), name in zip(mails, ['Bob', 'Ann']):
+            self.assertIn(f'Subject: Hi {name}\n', mail)
+            self.assertIn(base64.b64encode(f'Dear {name}'.encode()).decode(),
+                          mail)
+            self.assertIn(base64.b64encode(b'report').decode(), mail)
+        self.assertFalse(preload.called)
+
+    def test_bulk_skips_refused_rows(self):
+        rows = [{'email': f'u{i}@y.com'} for i in range(20)]
+        variants = {'sync': 1, 'pool': 4, 'async': 4}
+        for variant, sessions in variants.items():
+            mails = build_bulk_emails(test_mail, rows, 'Hi', 'msg')
+            with self.subTest(variant=variant), \
+                    SMTPSink(refused={'u3@y.com'}) as sink:
+                if variant == 'async':
+                    conn = AsyncSMTPConnection(1, test_mail, test_pwd,
+                                               sink.server, True)
+                    loop = asyncio.new_event_loop()
+                    results = loop.run_until_complete(conn.send_mails(
+                        list(mails), sessions=sessions, skip_failed=True))
+                    loop.close()
+                else:
+                    with SMTPConnection(1, test_mail, test_pwd, sink.server,
+                                        True, pool_size=sessions) as conn:
+                        results = conn.send_mails(mails, skip_failed=True)
+
+                failed = [i for i, e in enumerate(results)
+                          if isinstance(e, SMTPPermanentException)]
+                self.assertEqual(failed, [3])
+                self.assertEqual(len(results), 20)
+                self.assertEqual(sink.stats.as_dict()['messages'], 19)
+
+    def test_bulk_malformed_rows(self):
+        variants = {'recipients.jsonl': '{"email": "r1@gmail.com"}\n[1]\n',
+                    'missing.jsonl': '\n{"name": "Bob"}\n',
+                    'broken.jsonl': '\n{"email": \n',
+                    'recipients.csv': 'email,name\nr1@gmail.com,Bob\n\n'
+                                      ',Ann\n'}
+        with tempfile.TemporaryDirectory() as dir:
+            for name, content in variants.items():
+                filename = path.join(dir, name)
+                with open(filename, mode='w') as file:
+                    file.write(content)
+                with self.subTest(name=name), \
+                        self.assertRaisesRegex(BulkException, 'Line [24] '):
+                    read_recipients(filename)
+
+    def test_splits_big_attachment(self):
+        content = os.urandom(50 * 1024)
+        with tempfile.TemporaryDirectory() as dir:
+            filename = path.join(dir, 'tmpfile')
+            small = path.join(dir, 'small.txt')
+            with open(filename, mode='wb') as file:
+                file.write(content)
+            with open(small, mode='wb') as file:
+                file.write(b'small')
+
+            mails = build_emails(test_mail, ['r@g.com'], 'subj', 'msg',
+                                 [small, filename], max_attach_size=0.01)
+            sizes = [len(str(e).encode()) for e in mails]
+            mails = [email.message_from_string(str(e)) for e in mails]
+
+        fragments = [(part.get_filename(), part.get_payload(decode=True))
+                     for mail in mails for part in mail.walk()
+                     if part.get_filename() not in (None, 'small.txt')]
+        self.assertEqual(len(mails), 8)
+        self.assertListEqual([e[0] for e in fragments],
+                             ['tmpfile.{:03d}'.format(i + 1)
+                              for i in range(8)])
+        self.assertTrue(all(size <= 0.01 * 1024 ** 2 for size in sizes))
+        self.assertEqual(b''.join(e[1] for e in fragments), content)
+
+    def test_bdat(self):
+        Tests.responses[b'EHLO owrld\r\n'] = [b'250-smtp.test\r\n',
+                                              b'250-PIPELINING\r\n',
+                                              b'250 CHUNKING\r\n']
+        mail = Mail(test_mail, ['r1@gmail.com'], 'subject', message='msg')
+        body = b''.join(mail.iter_chunks())
+        chunks = [body[i:i + 100] for i in range(0, len(body), 100)]
+        envelope = 'MAIL FROM:<{}>\r\nRCPT TO:<r1@gmail.com>\r\n'.format(
+            test_mail).encode()
+
+        with SMTPClient(test_mail, test_pwd, chunk_size=100) as smtp:
+            Tests.pending_responses = [b'250 ok'] * (len(chunks) + 2)
+            smtp.send_mail(mail)
+            self.assertListEqual(Tests.pending_responses, [])
+
+        valid_requests = [envelope]
+        for i, chunk in enumerate(chunks):
+            last = ' LAST' if i == len(chunks) - 1 else ''
+            valid_requests.append(
+                'BDAT {}{}\r\n'.format(len(chunk), last).encode() + chunk)
+        self.assertListEqual(self.requests, self.get_requests(valid_requests))
+
+    def test_response_reader(self):
+        class Sock:
+            chunks = [b'250-first\r\n250-sec', b'ond\r\n250 last\r\n354 go',
+                      b'\r\n550 no\r\n221 bye\r\n']
+
+            def recv_into(self, buffer):
+                chunk = self.chunks.pop(0)
+                buffer[:len(chunk)] = chunk
+                return len(chunk)
+
+        reader = ResponseReader(Sock(), buffer_size=64)
+        self.assertEqual(reader.read_reply(),
+                         b'250-first\r\n250-second\r\n250 last\r\n')
+        self.assertEqual(reader.pending, 0)
+        self.assertEqual(reader.read_replies(2),
+                         [b'354 go\r\n', b'550 no\r\n'])
+        self.assertEqual(reader.pending, 1)
+        self.assertEqual(reader.read_reply(), b'221 bye\r\n')
+
+        code, resp = parse_response(b'550 no such user\r\n')
+        self.assertEqual((code, resp), (550, b'550 no such user\r\n'))
+        self.assertEqual(str(get_response_exception(code, resp)),
+                         'no such user')
+
+    def test_dot_stuffing(self):
+        chunks = [b'.a\nb', b'\n.c\n', memoryview(b'.d'), b'', b'e.\n']
+        self.assertEqual(b''.join(dot_stuff(chunks)), b'..a\nb\n..c\n..de.\n')
+
+    def test_spool(self):
+        mails = [Mail(test_mail, ['r{}@gmail.com'.format(i)], 'subject',
+                      message='msg') for i in range(2)]
+        busy = SMTPTemporaryException('busy')
+        busy.delivered = ['b@gmail.com']
+        conn = MockSpoolConnection([busy, SMTPPermanentException('no')])
+        delays = []
+
+        with tempfile.TemporaryDirectory() as dir:
+            spool = Spool(dir)
+            for mail in mails:
+                spool.submit(mail, bcc=['b@gmail.com'])
+            stats = SpoolWorker(spool, conn,
+                                retry_policy=RetryPolicy(base_delay=0)).run(
+                sleep=delays.append)
+            queued = list(spool.iter_messages())
+            sent = []
+            for filename in os.listdir(path.join(dir, 'sent')):
+                with open(path.join(dir, 'sent', filename)) as file:
+                    sent.append(json.load(file))
+
+        self.assertEqual(stats, {'queued': 0, 'sent': 1, 'failed': 1})
+        self.assertEqual(len(delays), 1)
+        self.assertIn(conn.sent[0], [str(e).encode() for e in mails])
+        self.assertListEqual([e.recipients[-1] == 'b@gmail.com'
+                              for e in queued], [True])
+        self.assertListEqual([e['recipients'][-1] == 'b@gmail.com'
+                              for e in sent], [False])
+
+    def test_spool_corrupt_entry(self):
+        mails = [Mail(test_mail, ['r{}@gmail.com'.format(i)], 'subject',
+                      message='msg') for i in range(2)]
+        conn = MockSpoolConnection([])
+        with tempfile.TemporaryDirectory() as dir:
+            spool = Spool(dir)
+            broken, _ = [spool.submit(mail) for mail in mails]
+            os.remove(spool.get_body_path(broken))
+            stats = SpoolWorker(spool, conn).run()
+            failed = list(spool.iter_messages())
+            locks = [e for e in os.listdir(dir) if e.endswith('.lock')]
+
+        self.assertEqual(stats, {'queued': 0, 'sent': 1, 'failed': 1})
+        self.assertEqual([e.message_id for e in failed], [broken])
+        self.assertIn('No such file', failed[0].meta['error'])
+        self.assertListEqual(locks, [])
+
+    @patch('smtpConnection.SMTPClient', MockRetryClient)
+    def test_retry_policy(self):
+        delays = []
+        policy = RetryPolicy(base_delay=1, jitter=0, connect_attempts=3,
+                             transient_attempts=2, sleep=delays.append)
+        MockRetryClient.connect_failures = [SMTPDisconnectedException('down')]
+        MockRetryClient.send_failures = [SMTPTemporaryException('busy')]
+        conn = SMTPConnection(3, test_mail, test_pwd, None, False,
+                              retry_policy=policy)
+        with conn:
+            self.assertEqual(conn.send_mail(None), {})
+
+        self.assertEqual(delays, [1, 1])
+        counters = conn.stats.as_dict()['counters']
+        self.assertEqual(counters, {'connect_failures': 1,
+                                    'connect_retries': 1,
+                                    'transient_failures': 1,
+                                    'transient_retries': 1})
+
+        MockRetryClient.send_failures = [SMTPTemporaryException('busy')] * 2
+        with self.assertRaises(SMTPTemporaryException):
+            conn.send_mail(None)
+
+    @patch('smtpConnection.SMTPClient', MockRetryClient)
+    def test_retry_connect_errors(self):
+        policy = RetryPolicy(base_delay=0, sleep=lambda delay: None)
+        MockRetryClient.connect_failures = [SMTPTemporaryException('421')]
+        MockRetryClient.send_failures = []
+        with SMTPConnection(1, test_mail, test_pwd, None, False,
+                            retry_policy=policy) as conn:
+            self.assertEqual(conn.send_mail(None), {})
+        self.assertEqual(conn.stats.as_dict()['counters'],
+                         {'transient_failures': 1, 'transient_retries': 1})
+
+        MockRetryClient.connect_failures = [SMTPPermanentException('535')]
+        conn = SMTPConnection(1, test_mail, test_pwd, None, False,
+                              retry_policy=policy, failure_threshold=1)
+        with self.assertRaises(SMTPPermanentException):
+            conn.send_mail(None)
+        self.assertFalse(conn.is_healthy(conn.servers[0]))
+
+    def test_circuit_breaker(self):
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10,
+                                 clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        now[0] = 10
+        self.assertEqual(breaker.state, 'half-open')
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        now[0] = 20
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_circuit_breaker_single_probe(self):
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10,
+                                 clock=lambda: now[0])
+        breaker.record_failure()
+        now[0] = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.state, 'open')
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+        breaker.record_failure()
+        now[0] = 20
+        self.assertTrue(breaker.allow())
+        now[0] = 30
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+    @patch('smtpConnection.SMTPClient', MockRelayClient)
+    def test_multiple_servers(self):
+        relay1, relay2, relay3 = ('r1', 25), ('r2', 25), ('r3', 25)
+        MockRelayClient.down = {relay3}
+        conn = SMTPConnection(3, test_mail, test_pwd,
+                              [(*relay1, 2), (*relay2, 1), (*relay3, 1)],
+                              False, pool_size=6,
+                              retry_policy=RetryPolicy(sleep=lambda e: None))
+        sessions = [conn.acquire() for _ in range(6)]
+
+        self.assertFalse(conn.is_healthy(relay3))
+        self.assertEqual(conn.get_outstanding(relay1), 4)
+        self.assertEqual(conn.get_outstanding(relay2), 2)
+        self.assertEqual(conn.get_outstanding(relay3), 0)
+
+        for smtp in sessions:
+            conn.release(smtp, discard=True)
+        self.assertEqual(conn.get_outstanding(relay1), 0)
+
+
+class SinkTests(unittest.TestCase):
+    def test_sink(self):
+        recipients = ['r1@gmail.com', 'r2@gmail.com']
+        mail = Mail(test_mail, recipients, 'subject', message='msg\n.\n')
+        variants = [{'chunking': False}, {'chunking': True}]
+        if shutil.which('openssl') is not None:
+            variants.append({'chunking': True, 'tls': True})
+
+        for variant in variants:
+            with self.subTest(**variant), \
+                    SMTPSink(refused={'r2@gmail.com'}, **variant) as sink:
+                with SMTPClient(test_mail, test_pwd, server=sink.server,
+                                disable_ssl=not variant.get('tls'),
+                                verify_tls=False) as smtp:
+                    refused = smtp.send_mail(mail)
+                    smtp.send_mail(mail)
+
+                self.assertEqual(list(refused), ['r2@gmail.com'])
+                self.assertEqual(sink.stats.as_dict()['messages'], 2)
+                sender, accepted, body = sink.messages[0]
+                self.assertEqual(accepted, ['r1@gmail.com'])
+                self.assertTrue(body.startswith(b''.join(mail.iter_chunks())))
+
+    def test_sink_recipient_limit(self):
+        recipients = [f'r{i}@{domain}.com'
+                      for domain in ('a', 'b') for i in range(4)]
+        mail = Mail(test_mail, recipients, 'subject', message='msg')
+        for pipelining in (False, True):
+            with self.subTest(pipelining=pipelining), \
+                    SMTPSink(max_recipients=3, pipelining=pipelining,
+                             refused={'r0@b.com'}) as sink:
+                with SMTPClient(test_mail, test_pwd, server=sink.server,
+                                disable_ssl=True, max_recipients=5) as smtp:
+                    refused = smtp.send_mail(mail, bcc=['r1@A.com'])
+
+                self.assertEqual(list(refused), ['r0@b.com'])
+                accepted = [rcpt for _, rcpts, _ in sink.messages
+                            for rcpt in rcpts]
+                self.assertListEqual(accepted, recipients[:4] +
+                                     recipients[5:])
+                self.assertListEqual([len(rcpts) for _, rcpts, _
+                                      in sink.messages], [3, 1, 3])
+
+    def test_sink_batch_retry(self):
+        recipients = [f'r{i}@a.com' for i in range(6)]
+        mail = Mail(test_mail, recipients, 'subject', message='msg')
+        policy = RetryPolicy(base_delay=0, sleep=lambda delay: None)
+        with SMTPSink(session_recipients=2, refused={'r4@a.com'}) as sink, \
+                SMTPConnection(1, test_mail, test_pwd, sink.server, True,
+                               retry_policy=policy) as conn:
+            refused = conn.send_mail(mail)
+
+        self.assertEqual(list(refused), ['r4@a.com'])
+        accepted = [rcpt for _, rcpts, _ in sink.messages for rcpt in rcpts]
+        self.assertListEqual(sorted(accepted), recipients[:4] + recipients[5:])
+        self.assertEqual(sink.stats.as_dict()['sessions'], 3)
+
+    def test_sink_pool_reuse_commands(self):
+        mail = Mail(test_mail, ['r1@gmail.com'], 'subject', message='msg')
+        for idle_check, noops in ((60, 0), (0, 2)):
+            with self.subTest(idle_check=idle_check), SMTPSink() as sink, \
+                    SMTPConnection(1, test_mail, test_pwd, sink.server, True,
+                                   idle_check=idle_check) as conn:
+                for _ in range(3):
+                    conn.send_mail(mail)
+
+            stats = sink.stats.as_dict()
+            self.assertEqual((stats['sessions'], stats['messages']), (1, 3))
+            self.assertEqual(stats['commands'].get('NOOP', 0), noops)
+            self.assertEqual(stats['commands']['RSET'], 2)
+
+    def test_sink_refused_keeps_session(self):
+        mail = Mail(test_mail, ['r1@gmail.com'], 'subject', message='msg')
+        with SMTPSink(refused={'r1@gmail.com'}) as sink, \
+                SMTPConnection(1, test_mail, test_pwd, sink.server,
+                               True) as conn:
+            for _ in range(2):
+                with self.assertRaises(SMTPPermanentException):
+                    conn.send_mail(mail)
+
+        self.assertEqual(sink.stats.as_dict()['sessions'], 1)
+
+    def test_daemon(self):
+        with tempfile.TemporaryDirectory() as dir, SMTPSink() as sink:
+            conn = SMTPConnection(1, test_mail, test_pwd, sink.server, True)
+            socket_path = path.join(dir, 'smtpd.sock')
+            with conn, MailDaemon(conn, socket_path, test_mail) as daemon:
+                daemon.warm_up()
+                self.assertEqual(sink.stats.as_dict()['sessions'], 1)
+                for i in range(2):
+                    response = submit(socket_path, build_request(
+                        ['r1@gmail.com'], subject='subj', message=f'msg{i}'))
+                    self.assertDictEqual(response, {'status': 'ok',
+                                                    'mails': 1,
+                                                    'refused': {}})
+                self.assertEqual(os.stat(socket_path).st_mode & 0o777,
+                                 0o600)
+                requests = {'validation': build_request(['bad']),
+                            'not_found': build_request(
+                                ['r1@gmail.com'],
+                                attachments=[path.join(dir, 'missing.txt')])}
+                for error_type, request in requests.items():
+                    response = submit(socket_path, request)
+                    self.assertEqual((response['status'],
+                                      response['error_type']),
+                                     ('error', error_type))
+                self.assertDictEqual(daemon.stats,
+                                     {'submitted': 2, 'failed': 2})
+            self.assertFalse(path.exists(socket_path))
+
+        stats = sink.stats.as_dict()
+        self.assertEqual((stats['sessions'], stats['messages']), (1, 2))
+
+    def test_daemon_partial_failure(self):
+        mail = Mail(test_mail, ['r1@gmail.com'], 'subject', message='msg')
+        conn = MockSpoolConnection([])
+        daemon = MailDaemon(conn, None, test_mail)
+        with patch('smtpDaemon.build_emails', return_value=[mail] * 3), \
+                patch.object(conn, 'send_mail', side_effect=[
+                    {}, SMTPDisconnectedException('down')]):
+            response = daemon.process(json.dumps(
+                build_request(['r1@gmail.com'])))
+
+        self.assertEqual((response['error_type'], response['sent'],
+                          response['failed']), ('unavailable', 1, 2))
+
+    def test_sink_lost_reply(self):
+        mail = Mail(test_mail, ['r1@gmail.com'], 'subject', message='msg')
+        policy = RetryPolicy(base_delay=0, sleep=lambda delay: None)
+        for chunking in (False, True):
+            with self.subTest(chunking=chunking), \
+                    SMTPSink(chunking=chunking, drop_replies=1) as sink:
+                conn = SMTPConnection(3, test_mail, test_pwd, sink.server,
+                                      True, retry_policy=policy)
+                with conn, self.assertRaises(SMTPDeliveryUnknownException):
+                    conn.send_mail(mail)
+                self.assertEqual(sink.stats.as_dict()['messages'], 1)
+
+    def test_sink_spool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = Spool(directory)
+            mails = [Mail(test_mail, ['r1@gmail.com'], 'subject',
+                          message='m' * 100000),
+                     Mail(test_mail, ['r1@gmail.com'], 'subject',
+                          attachments=[('a.txt', '.line\n')])]
+            message_ids = [spool.submit(mail) for mail in mails]
+            spooled = list(spool.iter_messages())
+            self.assertEqual(
+                {mail.message_id: mail.dot_safe for mail in spooled},
+                dict(zip(message_ids, [True, False])))
+
+            for chunking in (False, True):
+                with self.subTest(chunking=chunking), \
+                        SMTPSink(chunking=chunking) as sink:
+                    with SMTPClient(test_mail, test_pwd, server=sink.server,
+                                    disable_ssl=True,
+                                    chunk_size=30000) as smtp:
+                        for mail in spooled:
+                            smtp.send_mail(mail)
+                    bodies = {body.rstrip(b'\r\n')
+                              for _, _, body in sink.messages}
+                    self.assertEqual(
+                        bodies, {b''.join(mail.iter_chunks()).rstrip(b'\n')
+                                 for mail in mails})
+
+    def test_tls_session_cache_lazy_context(self):
+        with patch('smtp.create_ssl_context',
+                   wraps=create_ssl_context) as create:
+            tls_sessions = TLSSessionCache(verify=False)
+            create.assert_not_called()
+            context = tls_sessions.context
+            self.assertIs(tls_sessions.context, context)
+        create.assert_called_once_with(verify=False)
+
+    @unittest.skipIf(shutil.which('openssl') is None, 'needs openssl')
+    def test_sink_tls_sessions(self):
+        for starttls in (False, True):
+            tls_sessions = TLSSessionCache(create_ssl_context(verify=False))
+            with self.subTest(starttls=starttls), \
+                    SMTPSink(tls=not starttls, starttls=starttls) as sink:
+                reused = []
+                for _ in range(2):
+                    with SMTPClient(test_mail, test_pwd, server=sink.server,
+                                    starttls=starttls,
+                                    tls_sessions=tls_sessions) as smtp:
+                        smtp.send_mail(Mail(test_mail, ['r1@gmail.com'],
+                                            'subject', message='msg'))
+                        reused.append(smtp.tls_session_reused)
+
+                self.assertEqual(reused, [False, True])
+                self.assertEqual(sink.stats.as_dict()['messages'], 2)
+
+        tls_sessions = TLSSessionCache(verify=False)
+        loop = asyncio.new_event_loop()
+        with SMTPSink(tls=True) as sink:
+            reused = []
+            for _ in range(2):
+                smtp = loop.run_until_complete(AsyncSMTPClient(
+                    test_mail, test_pwd, server=sink.server,
+                    tls_sessions=tls_sessions).connect())
+                reused.append(smtp.tls_session_reused)
+                loop.run_until_complete(smtp.close())
+        loop.close()
+        self.assertEqual(reused, [False, True])
+
+        with SMTPSink(starttls=True) as sink, \
+                self.assertRaisesRegex(SMTPPermanentException,
+                                       'verification failed'):
+            SMTPClient(test_mail, test_pwd, server=sink.server,
+                       starttls=True)
+
+        error = SSLError(1, 'certificate verify failed')
+        error.reason = 'CERTIFICATE_VERIFY_FAILED'
+        with SMTPSink(tls=True) as sink, \
+                patch.object(SSLSocket, 'do_handshake',
+                             side_effect=error), \
+                self.assertRaisesRegex(SMTPPermanentException,
+                                       'verification failed'):
+            SMTPClient(test_mail, test_pwd, server=sink.server)
+
+        loop = asyncio.new_event_loop()
+        with SMTPSink(tls=True) as sink, \
+                self.assertRaisesRegex(SMTPPermanentException,
+                                       'verification failed'):
+            loop.run_until_complete(AsyncSMTPClient(
+                test_mail, test_pwd, server=sink.server).connect())
+        loop.close()
+
+        with SMTPSink() as sink, self.assertRaises(SMTPPermanentException):
+            SMTPClient(test_mail, test_pwd, server=sink.server,
+                       starttls=True)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from mail import EmailValidationException
+from recipients import RecipientSet
+from retry import RetryPolicy
+from smtp import DOT_LINE_RE, SMTPDisconnectedException, \
+    SMTPPermanentException, SMTPTemporaryException
+
+QUEUED = 'queued'
+SENT = 'sent'
+FAILED = 'failed'
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+MAX_ATTEMPTS = 10
+LOCK_TIMEOUT = 3600
+POLL_INTERVAL = 1
+READ_BLOCK_SIZE = 1024 ** 2
+
+
+class SpooledMail:
+    def __init__(self, spool, message_id, meta):
+        self._spool = spool
+        self._message_id = message_id
+        self._meta = meta
+
+    @property
+    def message_id(self):
+        return self._message_id
+
+    @property
+    def meta(self):
+        return self._meta
+
+    @property
+    def path(self):
+        return self._spool.get_body_path(self._message_id)
+
+    @property
+    def recipients(self):
+        return self._meta['recipients']
+
+    @property
+    def sender(self):
+        return self._meta['sender']
+
+    @property
+    def size(self):
+        return self._meta['size']
+
+    @property
+    def dot_safe(self):
+        return self._meta.get('dot_safe', False)
+
+    def iter_chunks(self):
+        with open(self.path, 'rb') as file:
+            while True:
+                chunk = file.read(READ_BLOCK_SIZE)
+                if not chunk:
+                    break
+                yield memoryview(chunk)
+
+
+class Spool:
+    def __init__(self, directory):
+        self._directory = directory
+        self._sent_directory = path.join(directory, SENT)
+        os.makedirs(self._sent_directory, exist_ok=True)
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def get_body_path(self, message_id):
+        return path.join(self._directory, f'{message_id}.eml')
+
+    def _get_meta_path(self, message_id):
+        return path.join(self._directory, f'{message_id}.json')
+
+    def _get_sent_path(self, message_id):
+        return path.join(self._sent_directory, f'{message_id}.json')
+
+    def _get_lock_path(self, message_id):
+        return path.join(self._directory, f'{message_id}.lock')
+
+    def _write_meta(self, message_id, meta):
+        tmp_path = self._get_meta_path(message_id) + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, self._get_meta_path(message_id))
+
+    def _read_meta(self, message_id):
+        with open(self._get_meta_path(message_id)) as file:
+            return json.load(file)
+
+    def submit(self, mail, bcc=None):
+        recipients = RecipientSet(mail.recipients)
+        if bcc is not None:
+            recipients.update(bcc)
+
+        message_id = uuid.uuid4().hex
+        body_path = self.get_body_path(message_id)
+        size = 0
+        dot_safe = True
+        line_start = True
+        with open(body_path + '.tmp', 'wb') as file:
+            for chunk in mail.iter_chunks():
+                if len(chunk) == 0:
+                    continue
+                if line_start and chunk[:1] == b'.' or \
+                        DOT_LINE_RE.search(chunk) is not None:
+                    dot_safe = False
+                line_start = chunk[-1:] == b'\n'
+                size += file.write(chunk)
+        os.replace(body_path + '.tmp', body_path)
+
+        self._write_meta(message_id, {'state': QUEUED,
+                                      'sender': mail.sender,
+                                      'recipients': list(recipients),
+                                      'size': size,
+                                      'dot_safe': dot_safe,
+                                      'attempts': 0,
+                                      'next_attempt': time.time(),
+                                      'error': None})
+        return message_id
+
+    def iter_messages(self):
+        for filename in sorted(os.listdir(self._directory)):
+            message_id, ext = path.splitext(filename)
+            if ext != '.json':
+                continue
+            try:
+                yield SpooledMail(self, message_id,
+                                  self._read_meta(message_id))
+            except (OSError, ValueError):
+                continue
+
+    def get_stats(self):
+        stats = {QUEUED: 0, SENT: 0, FAILED: 0}
+        for mail in self.iter_messages():
+            stats[mail.meta['state']] += 1
+        stats[SENT] += sum(1 for filename in os.listdir(self._sent_directory)
+                           if filename.endswith('.json'))
+        return stats
+
+    def get_next_attempt(self):
+        return min((mail.meta['next_attempt']
+                    for mail in self.iter_messages()
+                    if mail.meta['state'] == QUEUED), default=None)
+
+    def claim(self, message_id):
+        lock_path = self._get_lock_path(message_id)
+        try:
+            if time.time() - path.getmtime(lock_path) > LOCK_TIMEOUT:
+                os.remove(lock_path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            return False
+        return True
+
+    def release(self, message_id):
+        try:
+            os.remove(self._get_lock_path(message_id))
+        except FileNotFoundError:
+            pass
+
+    def claim_due(self, now=None):
+        now = time.time() if now is None else now
+        for mail in self.iter_messages():
+            meta = mail.meta
+            if meta['state'] != QUEUED or meta['next_attempt'] > now:
+                continue
+            if not self.claim(mail.message_id):
+                continue
+            try:
+                mail = SpooledMail(self, mail.message_id,
+                                   self._read_meta(mail.message_id))
+            except (OSError, ValueError):
+                mail.meta['state'] = None
+            if mail.meta['state'] == QUEUED:
+                yield mail
+            else:
+                self.release(mail.message_id)
+
+    def _update(self, mail, **changes):
+        mail.meta.update(changes)
+        self._write_meta(mail.message_id, mail.meta)
+
+    def mark_sent(self, mail, refused=None):
+        self._update(mail, state=SENT, error=None, refused=refused)
+        os.remove(mail.path)
+        os.replace(self._get_meta_path(mail.message_id),
+                   self._get_sent_path(mail.message_id))
+
+    def mark_failed(self, mail, error):
+        self._update(mail, state=FAILED, error=error)
+
+    def reschedule(self, mail, delay, error, done=()):
+        recipients = RecipientSet(mail.recipients)
+        recipients.difference_update(done)
+        self._update(mail, attempts=mail.meta['attempts'] + 1,
+                     next_attempt=time.time() + delay, error=error,
+                     recipients=list(recipients))
+
+
+class SpoolWorker:
+    def __init__(self, spool, connection, max_attempts=MAX_ATTEMPTS,
+                 retry_policy=None):
+        self._spool = spool
+        self._connection = connection
+        self._max_attempts = max_attempts
+        self._retry_policy = retry_policy
+        if retry_policy is None:
+            self._retry_policy = RetryPolicy(base_delay=RETRY_DELAY,
+                                             max_delay=MAX_RETRY_DELAY)
+
+    def _deliver(self, mail):
+        try:
+            refused = self._connection.send_mail(mail)
+        except (SMTPPermanentException, EmailValidationException,
+                OSError) as e:
+            logging.warning(f'Mail {mail.message_id} failed: {e}')
+            self._spool.mark_failed(mail, str(e))
+        except (SMTPTemporaryException, SMTPDisconnectedException) as e:
+            attempts = mail.meta['attempts'] + 1
+            if attempts >= self._max_attempts:
+                logging.warning(f'Mail {mail.message_id} failed after '
+                                f'{attempts} attempts: {e}')
+                self._spool.mark_failed(mail, str(e))
+            else:
+                delay = self._retry_policy.get_delay(mail.meta['attempts'])
+                logging.info(f'Mail {mail.message_id} deferred for '
+                             f'{delay:.0f}s: {e}')
+                self._spool.reschedule(mail, delay, str(e),
+                                       done=[*e.delivered, *e.refused])
+        else:
+            self._spool.mark_sent(mail, refused=refused or None)
+        finally:
+            self._spool.release(mail.message_id)
+
+    def run_once(self):
+        pool_size = getattr(self._connection, 'pool_size', 1)
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            return len(list(executor.map(self._deliver,
+                                         self._spool.claim_due())))
+
+    def run(self, sleep=time.sleep):
+        while True:
+            delivered = self.run_once()
+            next_attempt = self._spool.get_next_attempt()
+            if next_attempt is None:
+                return self._spool.get_stats()
+            delay = next_attempt - time.time()
+            if delivered == 0:
+                delay = max(delay, POLL_INTERVAL)
+            sleep(max(0, delay))